@@ -0,0 +1,567 @@
+import random
+
+import numpy as np
+
+from tokaido_game import (
+    ACHIEVEMENT_PTS,
+    BATHS,
+    CARD_CODES,
+    CARD_FACES,
+    DONATION_PTS,
+    ENCOUNTER_VALUE,
+    ENCOUNTERS,
+    FARM_PAYMENT,
+    MAX_DONATIONS,
+    MEAL_PTS,
+    MEALS,
+    MIN_DONATIONS,
+    PANORAMA_SIZES,
+    PANORAMAS,
+    SOUVENIR_INDEX,
+    SOUVENIR_PTS,
+    SOUVENIRS,
+    SOUVENIRS_OFFERED,
+    TEMPLE_PTS,
+    TokaidoGame,
+    Traveler,
+)
+
+Action = TokaidoGame.Action
+Space = TokaidoGame.Space
+
+# every physical card gets its own column in the pile masks; these map a card
+# to the index of its face in CARD_FACES
+ENCOUNTER_CARDS = np.array(
+    [i for i, (_, num) in enumerate(ENCOUNTERS) for _ in range(num)]
+)
+MEAL_CARDS = np.array([i for i, (_, _, num) in enumerate(MEALS) for _ in range(num)])
+SOUVENIR_CARDS = np.array(
+    [i for i, (_, _, num) in enumerate(SOUVENIRS) for _ in range(num)]
+)
+BATH_CARDS = np.array([i for i, (_, num) in enumerate(BATHS) for _ in range(num)])
+PILE_CARDS = {
+    "encounters": ENCOUNTER_CARDS,
+    "meals": MEAL_CARDS,
+    "souvenirs": SOUVENIR_CARDS,
+    "baths": BATH_CARDS,
+}
+
+MEAL_COSTS = np.array([cost for _, cost, _ in MEALS])
+SOUVENIR_COSTS = np.array([cost for _, cost, _ in SOUVENIRS])
+SOUVENIR_KINDS = np.array([SOUVENIR_INDEX[typ] for typ, _, _ in SOUVENIRS])
+BATH_POINTS = np.array([pts for pts, _ in BATHS])
+
+ENCOUNTER_TYPES = CARD_FACES["encounters"]
+ENCOUNTER_COINS = ENCOUNTER_TYPES.index("coins")
+ENCOUNTER_SOUVENIR = ENCOUNTER_TYPES.index("souvenir")
+ENCOUNTER_DONATIONS = ENCOUNTER_TYPES.index("donations")
+ENCOUNTER_POINTS = ENCOUNTER_TYPES.index("points")
+# panorama index of each encounter face, or -1 if it is not a panorama
+ENCOUNTER_PANORAMA = np.array(
+    [PANORAMAS.index(typ) if typ in PANORAMAS else -1 for typ in ENCOUNTER_TYPES]
+)
+
+PANORAMA_SIZE = np.array(PANORAMA_SIZES)
+SOUVENIR_POINTS = np.array(SOUVENIR_PTS)
+TEMPLE_POINTS = np.array(TEMPLE_PTS)
+
+# rows are the subsets of the souvenirs on offer, columns the shop slots
+SUBSET_SLOTS = np.array(
+    [
+        [subset >> slot & 1 for slot in range(SOUVENIRS_OFFERED)]
+        for subset in range(1 << SOUVENIRS_OFFERED)
+    ],
+    dtype=bool,
+)
+
+
+class BatchPlayout:
+    # plays random playouts of many games in lockstep, with one NumPy array
+    # per piece of state and the game index as the first axis; the random
+    # policy matches TokaidoGame.random_playout
+
+    # rng is a NumPy Generator; without one, the seed comes from a copy of the
+    # first game's generator, leaving the game's own stream where it was, so
+    # calls without rng on the same game play the same playouts
+    def __init__(self, games, rng=None):
+        if rng is None:
+            stream = random.Random()
+            stream.setstate(games[0].rng.getstate())
+            rng = np.random.default_rng(stream.getrandbits(128))
+        self.rng = rng
+
+        board = TokaidoGame.board
+        self.board_len = len(board)
+        # a move never goes further than the last space of the next inn
+        inns = [pos for pos, space in enumerate(board) if space == Space.INN]
+        last_inn = {}
+        for inn in reversed(inns):
+            last_inn[inn] = last_inn.get(inn + 1, inn)
+        self.reach = max(
+            last_inn[min(inn for inn in inns if inn > pos and inn - 1 not in inns)]
+            - pos
+            for pos in range(inns[-1] - len(games[0].players) + 1)
+        )
+
+        # board lookups, padded past the end so a move's look-ahead window
+        # never has to be clipped
+        padding = [None] * (self.reach + 1)
+        self.space = np.array(board)
+        self.on_board = np.array([True] * len(board) + [False] * len(padding))
+        self.is_inn = np.array([space == Space.INN for space in board + padding])
+        self.on_road = np.array(
+            [games[0].on_road(pos) for pos in range(len(board))] + [True] * len(padding)
+        )
+        self.needs_coin = np.array(
+            [space in (Space.SHOP, Space.TEMPLE) for space in board + padding]
+        )
+        self.space_panorama = np.array(
+            [
+                (
+                    PANORAMAS.index(space.name.lower())
+                    if space is not None and space.name.lower() in PANORAMAS
+                    else -1
+                )
+                for space in board + padding
+            ]
+        )
+
+        num_games = len(games)
+        num_players = len(games[0].players)
+        assert all(g.gastro == games[0].gastro for g in games)
+        self.meals_offered = num_players + 1 - games[0].gastro
+
+        def player_field(get):
+            return np.array([[get(p) for p in g.players] for g in games])
+
+        self.traveler = player_field(lambda p: p.traveler)
+        self.points = player_field(lambda p: p.points)
+        self.coins = player_field(lambda p: p.coins)
+        self.meals = player_field(lambda p: p.meals)
+        self.panoramas = player_field(lambda p: p.panoramas)
+        self.encounters = player_field(lambda p: p.encounters)
+        self.baths = player_field(lambda p: p.baths)
+        self.donations = player_field(lambda p: p.donations)
+        self.souvenirs = player_field(lambda p: p.souvenirs)
+        self.achievements = player_field(lambda p: p.achievements)
+
+        self.positions = np.array([g.positions for g in games])
+        self.turn = np.array([g.turn for g in games])
+        self.whose_turn = np.array([g.whose_turn for g in games])
+        self.pano_achievments = np.array([g.pano_achievments for g in games])
+
+        self.piles = {
+            typ: np.zeros((num_games, len(cards)), dtype=bool)
+            for typ, cards in PILE_CARDS.items()
+        }
+        self.available_meals = np.full((num_games, self.meals_offered), -1)
+        self.available_souvenirs = np.full((num_games, SOUVENIRS_OFFERED), -1)
+        self.encounter_choices = np.full((num_games, 2), -1)
+        self.satsuki_meal_draw = np.full(num_games, -1)
+        first = {}
+        for i, game in enumerate(games):
+            j = first.setdefault(id(game), i)
+            if j == i:
+                self.load_cards(i, game)
+            else:
+                self.copy_cards(i, j)
+
+    def load_cards(self, i, game):
+        # marks the cards in game's piles, then gives the face up cards
+        # physical cards that are not in a pile
+        spare = {}
+        for typ, cards in PILE_CARDS.items():
+            counts = np.bincount(
+                np.frombuffer(
+                    game.cards[typ].codes, dtype=np.uint8, count=len(game.cards[typ])
+                ),
+                minlength=cards.max() + 1,
+            )
+            for face, num in enumerate(counts):
+                where = np.flatnonzero(cards == face)
+                self.piles[typ][i, where[:num]] = True
+                spare[typ, face] = list(where[num:])
+
+        def place(typ, faces, row):
+            for j, face in enumerate(faces):
+                row[j] = spare[typ, CARD_CODES[typ][face]].pop()
+
+        # the offers are left behind once they are resolved, so only load the
+        # ones still in play
+        if game.turn == Action.EAT:
+            place("meals", game.available_meals, self.available_meals[i])
+        elif game.turn == Action.BUY:
+            place("souvenirs", game.available_souvenirs, self.available_souvenirs[i])
+        elif game.turn == Action.CHOOSE_ENCOUNTER:
+            place("encounters", game.encounter_choices, self.encounter_choices[i])
+        if game.satsuki_meal_draw is not None:
+            place("meals", [game.satsuki_meal_draw], self.satsuki_meal_draw[i : i + 1])
+
+    def copy_cards(self, i, j):
+        # game i starts from the same state as game j
+        for pile in self.piles.values():
+            pile[i] = pile[j]
+        self.available_meals[i] = self.available_meals[j]
+        self.available_souvenirs[i] = self.available_souvenirs[j]
+        self.encounter_choices[i] = self.encounter_choices[j]
+        self.satsuki_meal_draw[i] = self.satsuki_meal_draw[j]
+
+    def run(self):
+        # plays every game to the end and returns players_beaten for each
+        while (self.turn != Action.FINISHED).any():
+            self.step()
+        return self.players_beaten()
+
+    def step(self):
+        # every unfinished game takes one action
+        turn = self.turn.copy()
+        for phase, handler in (
+            (Action.MOVE, self.move),
+            (Action.BUY, self.buy),
+            (Action.DONATE, self.donate),
+            (Action.CHOOSE_ENCOUNTER, self.choose_encounter),
+            (Action.CHOOSE_PANORAMA, self.choose_panorama),
+            (Action.EAT, self.eat),
+        ):
+            g = np.flatnonzero(turn == phase)
+            if len(g):
+                handler(g, self.whose_turn[g])
+
+    def draw_cards(self, typ, g, num):
+        # returns a (len(g), num) array of cards, -1 where the pile ran out
+        pile = self.piles[typ]
+        drawn = np.full((len(g), num), -1)
+        for j in range(num):
+            keys = self.rng.random((len(g), pile.shape[1]))
+            keys[~pile[g]] = -1
+            card = keys.argmax(1)
+            ok = keys[np.arange(len(g)), card] >= 0
+            drawn[ok, j] = card[ok]
+            pile[g[ok], card[ok]] = False
+        return drawn
+
+    def return_cards(self, typ, g, cards):
+        if cards.ndim > 1:
+            g = np.repeat(g, cards.shape[1])
+            cards = cards.ravel()
+        ok = cards >= 0
+        self.piles[typ][g[ok], cards[ok]] = True
+
+    def sample(self, options):
+        # index of a uniformly chosen True column in each row, -1 if none
+        keys = self.rng.random(options.shape)
+        keys[~options] = -1
+        choice = keys.argmax(1)
+        return np.where(options.any(1), choice, -1)
+
+    def move(self, g, p):
+        n = len(g)
+        rows = np.arange(n)
+        board_len = self.board_len
+        ahead = np.arange(self.reach)
+        start = self.positions[g, p] + 1
+        here = start[:, None] + ahead
+
+        occupied = np.zeros((n, len(self.on_board)), dtype=bool)
+        occupied[rows[:, None], self.positions[g]] = True
+        # the extra column is never complete, for spaces that are not panoramas
+        complete = np.zeros((n, len(PANORAMAS) + 1), dtype=bool)
+        complete[:, :-1] = self.panoramas[g, p] >= PANORAMA_SIZE
+        legal = (
+            self.on_board[here]
+            & ~np.take_along_axis(occupied, here, 1)
+            & (self.on_road[here] | np.take_along_axis(occupied, here + 1, 1))
+            & ~(self.needs_coin[here] & (self.coins[g, p] < 1)[:, None])
+            & ~complete[rows[:, None], self.space_panorama[here]]
+        )
+        stop = (legal & self.is_inn[here]).argmax(1)
+        legal &= ahead <= stop[:, None]
+
+        # each move further along is half as likely as the one before it
+        rank = np.cumsum(legal, 1)
+        cum_weights = np.cumsum(np.where(legal, 0.5**rank, 0.0), 1)
+        u = self.rng.random(n) * cum_weights[:, -1]
+        dest = start + (cum_weights <= u[:, None]).sum(1)
+
+        self.positions[g, p] = dest
+        space = self.space[dest]
+        traveler = self.traveler[g, p]
+        early = dest < board_len - 5
+
+        inn = space == Space.INN
+        m = inn & (traveler == Traveler.Satsuki)
+        self.satsuki_meal_draw[g[m]] = self.draw_cards("meals", g[m], 1)[:, 0]
+        m = inn & early & (traveler == Traveler.Chuubei)
+        self.encounter(g[m], p[m])
+        m = inn & early & (traveler == Traveler.Hiroshige)
+        self.turn[g[m]] = Action.CHOOSE_PANORAMA
+
+        m = space == Space.SHOP
+        self.available_souvenirs[g[m]] = self.draw_cards(
+            "souvenirs", g[m], SOUVENIRS_OFFERED
+        )
+        self.turn[g[m]] = Action.BUY
+
+        m = space == Space.TEMPLE
+        self.turn[g[m]] = Action.DONATE
+
+        m = space == Space.ENCOUNTER
+        yoshiyasu = m & (traveler == Traveler.Yoshiyasu)
+        self.encounter_choices[g[yoshiyasu]] = self.draw_cards(
+            "encounters", g[yoshiyasu], 2
+        )
+        self.turn[g[yoshiyasu]] = Action.CHOOSE_ENCOUNTER
+        self.encounter(g[m & ~yoshiyasu], p[m & ~yoshiyasu])
+
+        m = space == Space.FARM
+        self.coins[g[m], p[m]] += FARM_PAYMENT
+
+        m = space == Space.HOT_SPRING
+        bath = self.draw_cards("baths", g[m], 1)[:, 0]
+        self.points[g[m], p[m]] += np.where(bath >= 0, BATH_POINTS[BATH_CARDS[bath]], 0)
+        self.baths[g[m], p[m]] += 1
+
+        pano = self.space_panorama[dest]
+        m = pano >= 0
+        self.collect_panorama(g[m], p[m], pano[m])
+
+        self.next_player_turn(g[self.turn[g] == Action.MOVE])
+
+    def encounter(self, g, p):
+        # draws and collects an encounter; games whose player may choose a
+        # panorama instead move to that phase
+        cards = self.draw_cards("encounters", g, 1)[:, 0]
+        panorama = self.collect_encounter(g, p, cards)
+        self.turn[g[panorama]] = Action.CHOOSE_PANORAMA
+
+    def collect_encounter(self, g, p, cards):
+        # returns which games may choose a panorama
+        choose = np.zeros(len(g), dtype=bool)
+        ok = cards >= 0
+        g, p, typ = g[ok], p[ok], ENCOUNTER_CARDS[cards[ok]]
+
+        self.encounters[g, p] += 1
+        m = self.traveler[g, p] == Traveler.Umegae
+        self.points[g[m], p[m]] += 1
+        self.coins[g[m], p[m]] += 1
+
+        m = typ == ENCOUNTER_SOUVENIR
+        card = self.draw_cards("souvenirs", g[m], 1)[:, 0]
+        got = card >= 0
+        self.collect_souvenir(
+            g[m][got], p[m][got], SOUVENIR_KINDS[SOUVENIR_CARDS[card[got]]]
+        )
+        m = typ == ENCOUNTER_COINS
+        self.coins[g[m], p[m]] += ENCOUNTER_VALUE["coins"]
+        m = typ == ENCOUNTER_POINTS
+        self.points[g[m], p[m]] += ENCOUNTER_VALUE["points"]
+        m = typ == ENCOUNTER_DONATIONS
+        self.donations[g[m], p[m]] += ENCOUNTER_VALUE["donations"]
+        self.points[g[m], p[m]] += ENCOUNTER_VALUE["donations"] * DONATION_PTS
+
+        pano = ENCOUNTER_PANORAMA[typ]
+        m = pano >= 0
+        room = self.panoramas[g[m], p[m], pano[m]] < PANORAMA_SIZE[pano[m]]
+        self.collect_panorama(g[m][room], p[m][room], pano[m][room])
+        full = np.zeros(len(g), dtype=bool)
+        full[np.flatnonzero(m)[~room]] = True
+        choose[np.flatnonzero(ok)[full]] = True
+        return choose
+
+    def collect_souvenir(self, g, p, kind):
+        owned = self.souvenirs[g, p]
+        pos = (owned > owned[np.arange(len(g)), kind][:, None]).sum(1)
+        self.souvenirs[g, p, kind] += 1
+        self.points[g, p] += SOUVENIR_POINTS[pos]
+
+    def collect_panorama(self, g, p, pano):
+        self.panoramas[g, p, pano] += 1
+        self.points[g, p] += self.panoramas[g, p, pano]
+        m = (self.panoramas[g, p, pano] == PANORAMA_SIZE[pano]) & (
+            self.pano_achievments[g, pano]
+        )
+        self.pano_achievments[g[m], pano[m]] = False
+        self.collect_achievement(g[m], p[m])
+
+    def collect_achievement(self, g, p):
+        self.achievements[g, p] += 1
+        self.points[g, p] += ACHIEVEMENT_PTS
+        self.points[g, p] += self.traveler[g, p] == Traveler.Mitsukuni
+
+    def buy(self, g, p):
+        offered = self.available_souvenirs[g]
+        cost = np.where(offered >= 0, SOUVENIR_COSTS[SOUVENIR_CARDS[offered]], 0)
+        chosen_cost = SUBSET_SLOTS * cost[:, None, :]
+        complete = ~(SUBSET_SLOTS & (offered < 0)[:, None, :]).any(2)
+        highest = np.maximum(chosen_cost.max(2), 1)
+        needed = chosen_cost.sum(2) - np.where(
+            (self.traveler[g, p] == Traveler.Zen_emon)[:, None], highest - 1, 0
+        )
+        subset = self.sample(complete & (needed <= self.coins[g, p][:, None]))
+        bought = SUBSET_SLOTS[subset]
+
+        for slot in range(SOUVENIRS_OFFERED):
+            m = bought[:, slot]
+            self.coins[g[m], p[m]] -= cost[m, slot]
+            self.collect_souvenir(
+                g[m], p[m], SOUVENIR_KINDS[SOUVENIR_CARDS[offered[m, slot]]]
+            )
+        self.return_cards("souvenirs", g, np.where(bought, -1, offered))
+        self.available_souvenirs[g] = -1
+
+        spent = np.where(bought, cost, 0)
+        m = self.traveler[g, p] == Traveler.Zen_emon
+        self.coins[g[m], p[m]] += np.maximum(spent[m].max(1), 1) - 1
+        m = (self.traveler[g, p] == Traveler.Sasayakko) & (bought.sum(1) >= 2)
+        self.coins[g[m], p[m]] += np.where(bought[m], cost[m], cost.max() + 1).min(1)
+
+        self.next_player_turn(g)
+
+    def donate(self, g, p):
+        most = np.minimum(MAX_DONATIONS, self.coins[g, p])
+        amount = self.rng.integers(MIN_DONATIONS, most + 1)
+        self.coins[g, p] -= amount
+        self.points[g, p] += amount * DONATION_PTS
+        self.donations[g, p] += amount
+        self.next_player_turn(g)
+
+    def choose_encounter(self, g, p):
+        choices = self.encounter_choices[g]
+        options = np.concatenate(
+            [choices >= 0, np.ones((len(g), 1), dtype=bool)], axis=1
+        )
+        pick = self.sample(options)
+        kept = np.arange(choices.shape[1]) == pick[:, None]
+        self.return_cards("encounters", g, np.where(kept, -1, choices))
+        self.encounter_choices[g] = -1
+
+        last = choices.shape[1] - 1
+        card = np.where(
+            pick <= last, choices[np.arange(len(g)), np.minimum(pick, last)], -1
+        )
+        panorama = self.collect_encounter(g, p, card)
+        self.turn[g[panorama]] = Action.CHOOSE_PANORAMA
+        self.next_player_turn(g[~panorama])
+
+    def choose_panorama(self, g, p):
+        options = np.concatenate(
+            [
+                self.panoramas[g, p] < PANORAMA_SIZE,
+                np.ones((len(g), 1), dtype=bool),
+            ],
+            axis=1,
+        )
+        pick = self.sample(options)
+        m = pick < len(PANORAMAS)
+        self.collect_panorama(g[m], p[m], pick[m])
+        self.next_player_turn(g)
+
+    def eat(self, g, p):
+        n = len(g)
+        rows = np.arange(n)
+        offered = self.available_meals[g]
+        face = MEAL_CARDS[offered]
+        cost = MEAL_COSTS[face]
+        reduction = (self.traveler[g, p] == Traveler.Kinko).astype(int)
+        eaten = self.meals[g, p]
+        satsuki = self.satsuki_meal_draw[g]
+        satsuki_face = MEAL_CARDS[satsuki]
+
+        options = np.concatenate(
+            [
+                (offered >= 0)
+                & (self.coins[g, p][:, None] >= cost - reduction[:, None])
+                & (eaten[:, None] >> face & 1 == 0),
+                np.ones((n, 1), dtype=bool),
+                (
+                    (self.traveler[g, p] == Traveler.Satsuki)
+                    & (satsuki >= 0)
+                    & (eaten >> satsuki_face & 1 == 0)
+                )[:, None],
+            ],
+            axis=1,
+        )
+        pick = self.sample(options)
+        num_offered = offered.shape[1]
+
+        m = pick < num_offered
+        slot = pick[m]
+        self.points[g[m], p[m]] += MEAL_PTS
+        self.coins[g[m], p[m]] -= cost[m, slot] - reduction[m]
+        self.meals[g[m], p[m]] |= 1 << face[m, slot]
+        self.available_meals[g[m], slot] = -1
+
+        m = pick == num_offered + 1
+        self.points[g[m], p[m]] += MEAL_PTS
+        self.meals[g[m], p[m]] |= 1 << satsuki_face[m]
+
+        self.next_player_turn(g)
+
+    def next_player_turn(self, g):
+        board_len = self.board_len
+        num_players = self.positions.shape[1]
+
+        was_eating = self.turn[g] == Action.EAT
+        eating = g[was_eating]
+        behind = self.positions[eating, self.whose_turn[eating]] - 1
+        match = self.positions[eating] == behind[:, None]
+        m = match.any(1)
+        self.whose_turn[eating[m]] = match[m].argmax(1)
+        eating = eating[~m]
+        finished = (
+            self.positions[eating, self.whose_turn[eating]] == board_len - num_players
+        )
+        self.end_of_game(eating[finished])
+        self.turn[eating[~finished]] = Action.MOVE
+
+        moving = g[~was_eating]
+        back = self.positions[moving].min(1)
+        m = self.is_inn[back] & ~self.is_inn[back - 1]
+        arrived = moving[m]
+        self.available_meals[arrived] = self.draw_cards(
+            "meals", arrived, self.meals_offered
+        )
+        self.whose_turn[arrived] = self.positions[arrived].argmax(1)
+        self.turn[arrived] = Action.EAT
+        moving = moving[~m]
+        self.whose_turn[moving] = self.positions[moving].argmin(1)
+        self.turn[moving] = Action.MOVE
+
+    def end_of_game(self, g):
+        bits = self.meals[g][..., None] >> np.arange(len(MEALS)) & 1
+        spent = (bits * MEAL_COSTS).sum(2)
+        for category in (
+            spent,
+            self.baths[g],
+            self.encounters[g],
+            self.souvenirs[g].sum(2),
+        ):
+            best = category == category.max(1, keepdims=True)
+            self.achievements[g] += best
+            self.points[g] += best * (
+                ACHIEVEMENT_PTS + (self.traveler[g] == Traveler.Mitsukuni)
+            )
+
+        # temple points go by rank among the distinct donation totals
+        donations = self.donations[g]
+        num_players = donations.shape[1]
+        earlier = np.tri(num_players, k=-1, dtype=bool)
+        first = ~((donations[:, :, None] == donations[:, None, :]) & earlier).any(2)
+        rank = (
+            (donations[:, None, :] > donations[:, :, None]) & first[:, None, :]
+        ).sum(2)
+        self.points[g] += np.where(donations > 0, TEMPLE_POINTS[rank], 0)
+
+        self.turn[g] = Action.FINISHED
+
+    def players_beaten(self):
+        points = self.points[:, :, None] - self.points[:, None, :]
+        achievements = self.achievements[:, :, None] - self.achievements[:, None, :]
+        beats = (points > 0) | ((points == 0) & (achievements > 0))
+        ties = (points == 0) & (achievements == 0)
+        return beats.sum(2) + 0.5 * ties.sum(2) - 0.5
+
+
+def batch_random_playouts(game, num, rng=None):
+    # players_beaten for num random playouts of game, as a (num, players) array
+    return BatchPlayout([game] * num, rng).run()
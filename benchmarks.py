@@ -0,0 +1,213 @@
+from tokaido_game import TokaidoGame
+from mcts import Mcts, VECTOR_MIN_CHILDREN, np
+from simulate_games import play_game
+import argparse
+import json
+import math
+import random
+import sys
+import time
+
+TRAVELERS = ["Chuubei", "Kinko", "Yoshiyasu", "Zen_emon"]
+SEED = 0
+
+
+# fastest of several timed runs, the one least disturbed by other work;
+# returns its time and what it returned
+def best_time(fn, repeat):
+    best, result = math.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        elapsed = time.perf_counter() - start
+        if elapsed < best:
+            best, result = elapsed, out
+    return best, result
+
+
+# a reproducible position where the player to move faces turn
+def position(turn):
+    game = TokaidoGame(TRAVELERS, SEED)
+    while game.turn != turn:
+        game.take_action(game.rng.choice(game.available_actions()))
+    return game
+
+
+def bench_playouts(num, repeat):
+    start = TokaidoGame(TRAVELERS, SEED)
+
+    def run():
+        rng = random.Random(SEED)
+        for _ in range(num):
+            game = start.clone(rng)
+            game.random_playout()
+
+    seconds, _ = best_time(run, repeat)
+    return {"playouts_per_sec": (num / seconds, "higher")}
+
+
+def bench_clone(num, repeat):
+    game = position(TokaidoGame.Action.EAT)
+    # search hands clones its own generator, so copying one is not measured
+    rng = random.Random(SEED)
+
+    def run():
+        for _ in range(num):
+            game.clone(rng)
+
+    seconds, _ = best_time(run, repeat)
+    return {"clone_usec": (seconds / num * 1e6, "lower")}
+
+
+# nodes of num children with random statistics, some unvisited and some tied,
+# as (first edge, exploration term) for Mcts.best_edge_scalar and
+# best_edge_vectorized
+def synthetic_nodes(tree, num, count, rng):
+    store = tree.store
+    nodes = []
+    for _ in range(count):
+        node = store.new_node(0)
+        store.expand(node, list(range(num)))
+        for edge in store.edges(node):
+            if rng.random() < 0.2:
+                continue
+            child = store.edge_node[edge] = store.new_node(0)
+            if rng.random() < 0.2:
+                store.trials[child] = 10
+                store.cum_value[child] = 15.0
+            else:
+                store.trials[child] = rng.randrange(50)
+                store.cum_value[child] = rng.random() * 3 * store.trials[child]
+        nodes.append((store.first_edge[node], rng.random() * 3))
+    return nodes
+
+
+# both ways of choosing a child, checking they agree from one child up to num
+# and timing them at num children
+def bench_best_edge(num, repeat):
+    if np is None:
+        return {}
+    rng = random.Random(SEED)
+    tree = Mcts(TokaidoGame(TRAVELERS, SEED), seed=SEED)
+    for size in range(1, num + 1):
+        for first, explore in synthetic_nodes(tree, size, 20, rng):
+            scalar = tree.best_edge_scalar(first, size, explore)
+            vectorized = tree.best_edge_vectorized(first, size, explore)
+            assert (
+                scalar == vectorized
+            ), "best_edge_vectorized chose edge {} rather than {}".format(
+                vectorized, scalar
+            )
+    nodes = synthetic_nodes(tree, num, 1000, rng)
+    results = {}
+    for name in ("scalar", "vectorized"):
+        fn = getattr(tree, "best_edge_" + name)
+
+        def run():
+            for first, explore in nodes:
+                fn(first, num, explore)
+
+        seconds, _ = best_time(run, repeat)
+        results["best_edge_{}_usec".format(name)] = (
+            seconds / len(nodes) * 1e6,
+            "lower",
+        )
+    return results
+
+
+def bench_search(name, game, rounds, repeat):
+    def run():
+        tree = Mcts(game, seed=SEED)
+        tree.do_rounds(rounds)
+        return len(tree.store)
+
+    seconds, nodes = best_time(run, repeat)
+    return {
+        name + "_rounds_per_sec": (rounds / seconds, "higher"),
+        name + "_nodes_per_sec": (nodes / seconds, "higher"),
+    }
+
+
+def bench_games(num, trials):
+    start = time.perf_counter()
+    for i in range(num):
+        play_game(TRAVELERS, trials, seed=SEED + i)
+    seconds = time.perf_counter() - start
+    return {"seconds_per_game": (seconds / num, "lower")}
+
+
+def run_benchmarks(args):
+    results = {}
+    results.update(bench_playouts(args.playouts, args.repeat))
+    results.update(bench_clone(10000, args.repeat))
+    results.update(bench_best_edge(VECTOR_MIN_CHILDREN, args.repeat))
+    positions = {
+        "early": TokaidoGame(TRAVELERS, SEED),
+        "shop": position(TokaidoGame.Action.BUY),
+        "meal": position(TokaidoGame.Action.EAT),
+    }
+    for name, game in positions.items():
+        results.update(bench_search(name, game, args.rounds, args.repeat))
+    results.update(bench_games(args.games, args.trials))
+    return {
+        metric: {"value": value, "better": better}
+        for metric, (value, better) in results.items()
+    }
+
+
+# metrics more than tolerance worse than the baseline, as messages
+def regressions(results, baseline, tolerance):
+    found = []
+    for metric, base in baseline.items():
+        if metric not in results:
+            continue
+        value = results[metric]["value"]
+        if base["better"] == "higher":
+            change = base["value"] / value - 1
+        else:
+            change = value / base["value"] - 1
+        if change > tolerance:
+            found.append(
+                "{0}: {1:.4g} against a baseline of {2:.4g} ({3:.0%} worse)".format(
+                    metric, value, base["value"], change
+                )
+            )
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--playouts", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=1000)
+    parser.add_argument("--games", type=int, default=1)
+    parser.add_argument("--trials", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="also write the results to OUTPUT")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="replace the baseline"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="allowed fraction worse"
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            sys.exit(0)
+        found = regressions(results, baseline, args.tolerance)
+        for message in found:
+            print("regression:", message, file=sys.stderr)
+        sys.exit(1 if found else 0)
@@ -0,0 +1,186 @@
+import time
+from collections import OrderedDict
+
+from tokaido_game import Deck
+
+
+# spaces the players have left to travel to the final inn, all together
+def road_left(game):
+    end = len(game.board) - len(game.players)
+    return sum(max(0, end - position) for position in game.positions)
+
+
+class ScriptedDeck(Deck):
+    # a deck that asks the enumerator standing in for the game's random numbers
+    # which card to draw
+    __slots__ = ()
+
+    def draw(self, enumerator, log=None):
+        i = enumerator.choose(self)
+        self.size -= 1
+        code = self.codes[i]
+        self.codes[i] = self.codes[self.size]
+        self.codes[self.size] = code
+        if log is not None:
+            log.append((self.undraw, i))
+        return code
+
+
+class DrawScript:
+    # the cards drawn by one action, stepped through every distinct outcome
+    # like an odometer. cards drawn by one draw_cards call are kept in
+    # ascending code order, since their order does not matter, and prob is the
+    # chance of the whole set being drawn
+    def __init__(self):
+        # per card drawn, the codes it could be and the index of the chosen one
+        self.options = []
+        self.chosen = []
+
+    def restart(self):
+        self.step = 0
+        self.prob = 1.0
+        self.call = None
+
+    def draw(self, deck, call):
+        if call != self.call:
+            self.call = call
+            self.drawn = 0
+            self.copies = {}
+            self.lowest = 0
+        live = deck.codes[: deck.size]
+        if self.step == len(self.options):
+            # when every code from lowest up has run out there is no ascending
+            # order, and any card stands in for a set that cannot be drawn
+            options = sorted(set(c for c in live if c >= self.lowest))
+            self.options.append(options or [live[0]])
+            self.chosen.append(0)
+        code = self.options[self.step][self.chosen[self.step]]
+        self.step += 1
+        if code < self.lowest:
+            self.prob = 0.0
+        # one ordering of the set, times how many orderings it has
+        copies = self.copies.get(code, 0)
+        self.prob *= live.count(code) / deck.size * (self.drawn + 1) / (copies + 1)
+        self.drawn += 1
+        self.copies[code] = copies + 1
+        self.lowest = code
+        return live.index(code)
+
+    # move on to the next outcome, returning False after the last
+    def advance(self):
+        options, chosen = self.options, self.chosen
+        while chosen and chosen[-1] == len(options[-1]) - 1:
+            options.pop()
+            chosen.pop()
+        if not chosen:
+            return False
+        chosen[-1] += 1
+        return True
+
+
+class DrawEnumerator:
+    # the random numbers of a game being solved, handing each draw to the
+    # script of the innermost action being expanded
+    def __init__(self, game):
+        self.game = game
+        self.scripts = []
+
+    def choose(self, deck):
+        # draw_cards appends to draws after each call, so its length tells
+        # calls apart
+        return self.scripts[-1].draw(deck, (id(deck), len(self.game.draws)))
+
+
+class OutOfBudget(Exception):
+    pass
+
+
+class EndgameSolver:
+    # exact expected players_beaten for positions near the end of the game,
+    # with every player choosing what is best for themselves and every set of
+    # cards that can be drawn weighed by its chance. solved positions are
+    # remembered by hash, forgetting the least recently used past table_size
+    def __init__(self, table_size=1 << 16):
+        self.table_size = table_size
+        self.table = OrderedDict()
+
+    # values of each action from a position, or None if the solve is not done
+    # by deadline (a perf_counter time) or within max_positions positions.
+    # positions solved before giving up are kept for the next attempt
+    def solve(self, game, deadline=None, max_positions=None):
+        self.deadline = deadline
+        self.positions_left = max_positions
+        state = self.prepare(game)
+        try:
+            return {
+                action: self.action_values(state, action)
+                for action in state.available_actions()
+            }
+        except OutOfBudget:
+            return None
+
+    # a copy of game that draws cards as the solver tells it to
+    def prepare(self, game):
+        state = game.clone()
+        for typ, deck in game.cards.items():
+            # the whole array, as cards on offer can be put back
+            scripted = state.cards[typ] = ScriptedDeck(deck.codes)
+            scripted.size = deck.size
+        state.rng = DrawEnumerator(state)
+        if state.hash is None:
+            state.hash = state.compute_hash()
+        return state
+
+    def position_values(self, state):
+        if self.positions_left is not None:
+            self.positions_left -= 1
+            if self.positions_left < 0:
+                raise OutOfBudget
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise OutOfBudget
+        if state.is_over():
+            return tuple(state.players_beaten(i) for i in range(len(state.players)))
+        if road_left(state) == 0:
+            # only the last meals are left, and no two orders of eating reach
+            # the same position, so they are neither hashed nor remembered
+            key, state.hash = state.hash, None
+            values = self.best_values(state)
+            state.hash = key
+            return values
+        table = self.table
+        found = table.get(state.hash)
+        if found is not None:
+            table.move_to_end(state.hash)
+            return found
+        values = table[state.hash] = self.best_values(state)
+        if len(table) > self.table_size:
+            table.popitem(last=False)
+        return values
+
+    # values of the action best for the player to move
+    def best_values(self, state):
+        mover = state.whose_turn
+        best = None
+        for action in state.available_actions():
+            values = self.action_values(state, action)
+            if best is None or values[mover] > best[mover]:
+                best = values
+        return best
+
+    # expected values after an action, over every set of cards it can draw
+    def action_values(self, state, action):
+        script = DrawScript()
+        state.rng.scripts.append(script)
+        totals = [0.0] * len(state.players)
+        while True:
+            script.restart()
+            record = state.make_action(action)
+            prob = script.prob
+            if prob:
+                for i, value in enumerate(self.position_values(state)):
+                    totals[i] += prob * value
+            state.undo_action(record)
+            if not script.advance():
+                break
+        state.rng.scripts.pop()
+        return tuple(totals)
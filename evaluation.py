@@ -0,0 +1,137 @@
+from tokaido_game import (
+    ACHIEVEMENT_PTS,
+    TEMPLE_PTS,
+    TokaidoGame,
+    Traveler,
+)
+import argparse
+import math
+import random
+import time
+
+# points a player is expected to gain before the end on top of their current
+# points, fitted by least squares to random playouts: a constant, an amount per
+# coin held and an amount per space left to travel
+BASE_VALUE = 1.0
+COIN_VALUE = 0.8
+SPACE_VALUE = 0.6
+# spread of the difference between two players' final points around the
+# estimate, for turning estimates into a chance of beating each opponent
+POINT_SPREAD = 7.0
+
+
+# points from achievements and temple donations if the game ended now
+def bonus_points(game):
+    players = game.players
+    bonus = [0] * len(players)
+    for category in [
+        [p.coins_spent_on_meals() for p in players],
+        [p.baths for p in players],
+        [p.encounters for p in players],
+        [sum(p.souvenirs) for p in players],
+    ]:
+        most = max(category)
+        for i, val in enumerate(category):
+            if val == most:
+                bonus[i] += ACHIEVEMENT_PTS
+                if players[i].traveler == Traveler.Mitsukuni:
+                    bonus[i] += 1
+
+    donations = [p.donations for p in players]
+    values = sorted(set(donations), reverse=True)
+    for i, val in enumerate(donations):
+        if val > 0:
+            bonus[i] += TEMPLE_PTS[values.index(val)]
+    return bonus
+
+
+def estimated_points(game):
+    last = len(game.board) - 1
+    estimates = []
+    for player, position, bonus in zip(
+        game.players, game.positions, bonus_points(game)
+    ):
+        left = last - position
+        # who ends up with the bonuses is less settled the more road is left
+        estimates.append(
+            player.points
+            + BASE_VALUE
+            + COIN_VALUE * player.coins
+            + SPACE_VALUE * left
+            + bonus * (1 - left / last)
+        )
+    return estimates
+
+
+# expected players_beaten for each player, exact once the game is over
+def evaluate(game):
+    if game.is_over():
+        return [game.players_beaten(i) for i in range(len(game.players))]
+    estimates = estimated_points(game)
+    return [
+        sum(
+            1 / (1 + math.exp((other - mine) / POINT_SPREAD))
+            for j, other in enumerate(estimates)
+            if j != i
+        )
+        for i, mine in enumerate(estimates)
+    ]
+
+
+# reproducible positions part way through random games
+def sample_positions(num, seed=0):
+    travelers = [tvlr.name for tvlr in Traveler]
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < num:
+        game = TokaidoGame(rng.sample(travelers, 4), rng.getrandbits(128))
+        for _ in range(rng.randrange(100)):
+            if game.is_over():
+                break
+            game.apply_action(game.random_action())
+        if not game.is_over():
+            positions.append(game)
+    return positions
+
+
+# how closely evaluate matches the mean of random playouts from the same
+# positions, and how long each takes
+def compare(positions, playouts):
+    errors = []
+    eval_seconds = playout_seconds = 0.0
+    for game in positions:
+        start = time.perf_counter()
+        estimate = evaluate(game)
+        eval_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        totals = [0] * len(game.players)
+        for _ in range(playouts):
+            # playouts carry on the position's own random numbers
+            state = game.clone(game.rng)
+            state.random_playout()
+            for i in range(len(totals)):
+                totals[i] += state.players_beaten(i)
+        playout_seconds += time.perf_counter() - start
+        errors.extend(e - t / playouts for e, t in zip(estimate, totals))
+
+    return {
+        "positions": len(positions),
+        "mean_abs_error": sum(abs(e) for e in errors) / len(errors),
+        "rms_error": math.sqrt(sum(e * e for e in errors) / len(errors)),
+        "eval_usec": eval_seconds / len(positions) * 1e6,
+        "playout_usec": playout_seconds / (len(positions) * playouts) * 1e6,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--positions", type=int, default=200)
+    parser.add_argument("--playouts", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for key, val in compare(
+        sample_positions(args.positions, args.seed), args.playouts
+    ).items():
+        print(key, val)
@@ -1,77 +1,938 @@
+import atexit
 import math
-from copy import deepcopy
+import multiprocessing
+import random
+import time
+from array import array
+from collections import Counter, OrderedDict, namedtuple
 
+import tokaido_game
+from endgame import EndgameSolver, road_left
+from evaluation import evaluate
+from tokaido_game import TokaidoGame, zobrist
 
-class Node:
-    C = 2
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-    def __init__(self, player: int):
-        # index of player who made the previous move
-        self.player = player
+# leaves selected per worker before a shared-tree batch is played out
+LEAVES_PER_WORKER = 8
+
+# a search limited only by nodes stops once this many rounds in a row have not
+# added one, as a tree whose every path ends the game stops growing
+STALL_ROUNDS = 1000
+
+# nodes with at least this many children are scored with NumPy, when it is
+# installed, rather than child by child. the NumPy path costs about 20us
+# however many children there are, against about 0.33us a child, so it only
+# pays from around 60 children, well past the 3-14 the game offers
+VECTOR_MIN_CHILDREN = 64
+
+# share of a search's budget an endgame solve may take before the search falls
+# back to iterations, and the positions a solve gets for each iteration of the
+# budget, about 20000 positions against 4000-6000 endgame iterations a second
+SOLVE_SHARE = 0.5
+SOLVE_POSITIONS_PER_ITERATION = 5
+
+# MAST value of an action feature no round has used yet, that of finishing
+# mid-table in a four player game
+MAST_DEFAULT_VALUE = 1.5
+
+# what a call to Mcts.search did and why it stopped
+SearchReport = namedtuple(
+    "SearchReport", ["iterations", "seconds", "iterations_per_sec", "nodes", "stop"]
+)
+
+
+class NodeStore:
+    # statistics for every node live in parallel arrays indexed by node number.
+    # a decision node's children are a contiguous run of edges, each holding an
+    # action and the node it leads to (-1 until the edge is first followed).
+    # pruned nodes and edge runs go on free lists to be reused
+
+    def __init__(self, capacity=1024):
         # times node has been visited
-        self.trials = 0
+        self.trials = array("q", [0]) * capacity
         # sum of values when node has been visited
-        self.cum_value = 0
-        # map of actions to resulting nodes
-        self.children = {}
+        self.cum_value = array("d", [0.0]) * capacity
+        # index of player who made the previous move
+        self.player = array("b", [0]) * capacity
+        # run of edges below a node, first_edge is -1 until it is expanded
+        self.first_edge = array("q", [-1]) * capacity
+        self.num_edges = array("l", [0]) * capacity
+        self.live = bytearray(capacity)
+        self.nodes_used = 0
+        self.free_nodes = []
+        # nodes handed out by new_node, including reused ones
+        self.allocated = 0
 
-    def idealness(self, parent_trials: int) -> float:
-        if self.trials == 0:
-            return 3
+        # action codes, see TokaidoGame.encode_action
+        self.edge_action = array("q", [0]) * capacity
+        self.edge_node = array("q", [-1]) * capacity
+        # with RAVE or MAST, TokaidoGame.action_feature of each edge's action and
+        # the all-moves-as-first statistics for it
+        self.edge_feature = array("q", [0]) * capacity
+        self.amaf_trials = array("q", [0]) * capacity
+        self.amaf_value = array("d", [0.0]) * capacity
+        self.edges_used = 0
+        # map of run lengths to the starts of free runs of that length
+        self.free_edges = {}
+
+        # chance nodes, reached by an action that draws cards, with maps of
+        # the cards drawn to the resulting nodes
+        self.outcomes = {}
+
+    def __len__(self):
+        return self.nodes_used - len(self.free_nodes)
+
+    def new_node(self, player):
+        if self.free_nodes:
+            node = self.free_nodes.pop()
         else:
-            return self.cum_value / self.trials + math.sqrt(
-                Node.C * math.log(parent_trials) / self.trials
-            )
+            node = self.nodes_used
+            self.nodes_used += 1
+            if node == len(self.trials):
+                extra = len(self.trials)
+                self.trials.extend(array("q", [0]) * extra)
+                self.cum_value.extend(array("d", [0.0]) * extra)
+                self.player.extend(array("b", [0]) * extra)
+                self.first_edge.extend(array("q", [-1]) * extra)
+                self.num_edges.extend(array("l", [0]) * extra)
+                self.live.extend(bytearray(extra))
+        self.allocated += 1
+        self.trials[node] = 0
+        self.cum_value[node] = 0.0
+        self.player[node] = player
+        self.first_edge[node] = -1
+        self.num_edges[node] = 0
+        self.live[node] = 1
+        return node
 
-    def best_action(self, game_state):
-        if not self.children:
-            return
+    # give a node one edge per action
+    def expand(self, node, actions, features=None):
+        num = len(actions)
+        if self.free_edges.get(num):
+            first = self.free_edges[num].pop()
+        else:
+            first = self.edges_used
+            self.edges_used += num
+            if self.edges_used > len(self.edge_node):
+                extra = max(len(self.edge_node), num)
+                self.edge_action.extend(array("q", [0]) * extra)
+                self.edge_node.extend(array("q", [-1]) * extra)
+                self.edge_feature.extend(array("q", [0]) * extra)
+                self.amaf_trials.extend(array("q", [0]) * extra)
+                self.amaf_value.extend(array("d", [0.0]) * extra)
+        self.edge_action[first : first + num] = array("q", actions)
+        if features is not None:
+            self.edge_feature[first : first + num] = array("q", features)
+        for edge in range(first, first + num):
+            self.edge_node[edge] = -1
+            self.amaf_trials[edge] = 0
+            self.amaf_value[edge] = 0.0
+        self.first_edge[node] = first
+        self.num_edges[node] = num
 
-        top_ideal = 0
-        for action in game_state.available_actions():
-            ideal = self.children[action].idealness(self.trials)
-            if ideal > top_ideal:
-                top_ideal = ideal
-                top_action = action
-        return top_action
+    def edges(self, node):
+        first = self.first_edge[node]
+        if first < 0:
+            return range(0)
+        return range(first, first + self.num_edges[node])
+
+    def find_edge(self, node, action):
+        for edge in self.edges(node):
+            if self.edge_action[edge] == action:
+                return edge
+        return -1
+
+    # free every node that can no longer be reached from root
+    def prune(self, root):
+        reached = bytearray(self.nodes_used)
+        reached[root] = 1
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            below = [self.edge_node[edge] for edge in self.edges(node)]
+            if node in self.outcomes:
+                below.extend(self.outcomes[node].values())
+            for child in below:
+                if child >= 0 and not reached[child]:
+                    reached[child] = 1
+                    stack.append(child)
+
+        for node in range(self.nodes_used):
+            if self.live[node] and not reached[node]:
+                self.live[node] = 0
+                self.free_nodes.append(node)
+                self.outcomes.pop(node, None)
+                first = self.first_edge[node]
+                if first >= 0:
+                    self.free_edges.setdefault(self.num_edges[node], []).append(first)
 
-    def create_children(self, game_state):
-        for action in game_state.available_actions():
-            if action not in self.children:
-                self.children[action] = Node(game_state.whose_turn)
+
+class TranspositionTable:
+    # bounded map from position hashes to nodes; the least recently used
+    # position is forgotten when it is full
+    def __init__(self, size):
+        self.size = size
+        self.nodes = OrderedDict()
+
+    # return the node stored for key, storing the one made by new_node if there
+    # is none
+    def lookup(self, key, new_node):
+        found = self.nodes.get(key)
+        if found is None:
+            found = self.nodes[key] = new_node()
+            if len(self.nodes) > self.size:
+                self.nodes.popitem(last=False)
+        else:
+            self.nodes.move_to_end(key)
+        return found
+
+    # forget positions whose nodes have been pruned
+    def purge(self, live):
+        for key in [key for key, node in self.nodes.items() if not live[node]]:
+            del self.nodes[key]
+
+
+class SearchStats:
+    # where an instrumented search has spent its time since the last move
+    PHASES = ["selection", "copy", "expansion", "playout", "backpropagation"]
+
+    def __init__(self, store):
+        self.store = store
+        self.calls = tokaido_game.CallCounter()
+        self.clear()
+
+    def clear(self):
+        self.rounds = 0
+        self.seconds = Counter()
+        # time spent in timed methods so far, to leave out of their callers
+        self.inner = 0.0
+        self.calls.counts = {}
+        self.depths = Counter()
+        self.branching = Counter()
+        self.playout_lengths = Counter()
+        self.allocated = self.store.allocated
+
+    # wrap method so its running time, less that of timed methods it calls,
+    # is added to phase, and game calls made in it are counted under phase
+    def timed(self, phase, method):
+        def run(*args):
+            outer = self.calls.phase
+            if outer is None:
+                tokaido_game.call_counter = self.calls
+            self.calls.phase = phase
+            inner = self.inner
+            start = time.perf_counter()
+            try:
+                return method(*args)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.seconds[phase] += elapsed - (self.inner - inner)
+                self.inner = inner + elapsed
+                self.calls.phase = outer
+                if outer is None:
+                    tokaido_game.call_counter = None
+
+        return run
+
+    def report(self):
+        calls = {phase: {} for phase in self.PHASES}
+        for (phase, name), num in self.calls.counts.items():
+            calls[phase][name] = num
+        lengths = self.playout_lengths
+        playouts = sum(lengths.values())
+        return {
+            "rounds": self.rounds,
+            "seconds": {phase: self.seconds[phase] for phase in self.PHASES},
+            "calls": calls,
+            "depth": dict(sorted(self.depths.items())),
+            "branching": dict(sorted(self.branching.items())),
+            "playout_length": {
+                "count": playouts,
+                "mean": (
+                    sum(num * n for num, n in lengths.items()) / playouts
+                    if playouts
+                    else 0.0
+                ),
+                "min": min(lengths, default=0),
+                "max": max(lengths, default=0),
+            },
+            "nodes": len(self.store),
+            "nodes_allocated": self.store.allocated - self.allocated,
+        }
 
 
 class Mcts:
-    def __init__(self, game_state):
+    def __init__(
+        self,
+        game_state,
+        workers=1,
+        shared_tree=False,
+        table_size=1 << 16,
+        seed=None,
+        instrument=False,
+        exploration=2,
+        unvisited_score=3,
+        widening=None,
+        cutoff=None,
+        prior_weight=0,
+        rave=None,
+        mast=None,
+        endgame=None,
+        book=None,
+    ):
         self.current_state = game_state
-        self.root = Node(game_state.whose_turn)
+        # the search's own random numbers, so how long it searches does not
+        # change the cards the real game draws
+        self.rng = random.Random(seed)
+        self.store = NodeStore()
+        self.root = self.store.new_node(game_state.whose_turn)
+        # index of the player choosing the next action from the root
+        self.to_move = game_state.whose_turn
+        # with several workers, either each searches its own tree and the root
+        # statistics are merged, or playouts from one shared tree are farmed out
+        self.workers = workers
+        self.shared_tree = shared_tree
+        # positions reached by different move orders share one node
+        self.table = TranspositionTable(table_size) if table_size else None
+        # idealness is the mean value plus sqrt(exploration * log(parent
+        # trials) / trials), or unvisited_score for an unexplored action
+        self.exploration = exploration
+        self.unvisited_score = unvisited_score
+        # progressive widening as (coefficient, exponent): actions are ordered
+        # by TokaidoGame.action_prior and a node with n trials only chooses
+        # among the first ceil(coefficient * n ** exponent) of them
+        self.widening = widening
+        # playouts stop after cutoff random actions and the evaluator estimates
+        # the rest; with a prior_weight, new nodes start with that many visits
+        # at the evaluator's estimate
+        self.cutoff = cutoff
+        self.prior_weight = prior_weight
+        # with rave, an equivalent number of visits k: edges also keep
+        # all-moves-as-first statistics from every round in which the player
+        # to move went on to take an action with the same action_feature, and
+        # an edge visited n times is scored with its mean value blended with
+        # those by weight sqrt(k / (3n + k)). with mast, a temperature:
+        # playouts pick actions with weight exp(mean value of the action's
+        # feature over all rounds / mast). neither is gathered from shared tree
+        # rounds
+        self.rave = rave
+        self.mast = mast
+        # map of action features to [trials, cumulative value]
+        self.mast_values = {}
+        # once the root has at most endgame spaces of road left, all players
+        # together, search tries to solve it exactly, keeping the values of
+        # its actions in solved, or an empty dict if the solve ran out of
+        # budget. solving leaves as well costs far more than it gains, as
+        # leaves reached by different draws rarely share positions
+        self.endgame = endgame
+        self.solver = None if endgame is None else EndgameSolver()
+        self.solved = None
+        # an OpeningBook the root's children are seeded from before a search
+        # and stored to after it, counting ply as the moves advanced past
+        self.book = book
+        self.ply = 0
+        # with instrument, the phases of each round are timed and counted by
+        # wrapping the methods for them; otherwise nothing is measured
+        self.stats = None
+        if instrument:
+            self.stats = SearchStats(self.store)
+            for phase, name in [
+                ("selection", "construct_path"),
+                ("copy", "copy_state"),
+                ("expansion", "expand"),
+                ("playout", "playout"),
+                ("backpropagation", "backpropagate"),
+            ]:
+                setattr(self, name, self.stats.timed(phase, getattr(self, name)))
 
-    # return the action that has been the most explored
+    # return the action that has been the most explored, or the one
+    # TokaidoGame.action_prior likes best if none has been, as when the time
+    # budget runs out before the root's children are visited
     def best_move(self):
-        most_trials = max([node.trials for node in self.root.children.values()])
-        for action, child in self.root.children.items():
-            if child.trials == most_trials:
-                return action
+        if self.solved:
+            mover = self.current_state.whose_turn
+            return max(self.solved, key=lambda action: self.solved[action][mover])
+        store = self.store
+        legal = self.current_state.available_actions()
+        best, most_trials = None, -1
+        for edge in store.edges(self.root):
+            child = store.edge_node[edge]
+            action = store.edge_action[edge]
+            if child >= 0 and store.trials[child] > most_trials and action in legal:
+                best, most_trials = action, store.trials[child]
+        if best is None:
+            best = max(legal, key=self.current_state.action_prior)
+        return best
+
+    # move the root to the child for an action that has just been taken in
+    # current_state, keeping the statistics already gathered below it and
+    # freeing the rest of the tree
+    def advance(self, action, game_state=None):
+        if game_state is not None:
+            self.current_state = game_state
+        store = self.store
+        edge = store.find_edge(self.root, action)
+        child = store.edge_node[edge] if edge >= 0 else -1
+        if child in store.outcomes:
+            child = store.outcomes[child].get(self.current_state.outcome(), -1)
+        if child < 0:
+            child = store.new_node(self.to_move)
+        self.root = child
+        self.to_move = self.current_state.whose_turn
+        self.solved = None
+        self.ply += 1
+        store.prune(self.root)
+        if self.table is not None:
+            self.table.purge(store.live)
+        if self.stats is not None:
+            self.stats.clear()
+
+    # what the search has done since the last move, if it is instrumented
+    def report(self):
+        return None if self.stats is None else self.stats.report()
+
+    # return the edge below node with the greatest idealness
+    def best_edge(self, node):
+        store = self.store
+        trials = store.trials
+        # the parent's part of the exploration term is shared by every child
+        explore = math.sqrt(self.exploration * math.log(trials[node]))
+        first, num = store.first_edge[node], store.num_edges[node]
+        if self.widening is not None:
+            coefficient, exponent = self.widening
+            num = min(num, max(1, math.ceil(coefficient * trials[node] ** exponent)))
+        if self.rave is not None:
+            return self.best_edge_rave(first, num, explore)
+        if np is not None and num >= VECTOR_MIN_CHILDREN:
+            return self.best_edge_vectorized(first, num, explore)
+        return self.best_edge_scalar(first, num, explore)
+
+    # the edge of the child with the highest idealness, scored one by one
+    def best_edge_scalar(self, first, num, explore):
+        store = self.store
+        trials, cum_value, edge_node = store.trials, store.cum_value, store.edge_node
+        top_ideal, top_edge = -math.inf, -1
+        for edge in range(first, first + num):
+            child = edge_node[edge]
+            if child < 0 or trials[child] == 0:
+                ideal = self.unvisited_score
+            else:
+                ideal = cum_value[child] / trials[child] + explore / math.sqrt(
+                    trials[child]
+                )
+            if ideal > top_ideal:
+                top_ideal, top_edge = ideal, edge
+        return top_edge
+
+    # best_edge_scalar for many children at once, choosing the same edge
+    def best_edge_vectorized(self, first, num, explore):
+        store = self.store
+        children = np.frombuffer(store.edge_node, np.int64, num, first * 8)
+        visited = children >= 0
+        trials = np.zeros(num)
+        cum_value = np.zeros(num)
+        trials[visited] = np.frombuffer(store.trials, np.int64)[children[visited]]
+        cum_value[visited] = np.frombuffer(store.cum_value)[children[visited]]
+        ideal = np.full(num, float(self.unvisited_score))
+        seen = trials > 0
+        ideal[seen] = cum_value[seen] / trials[seen] + explore / np.sqrt(trials[seen])
+        return first + int(np.argmax(ideal))
+
+    # best_edge with each edge's mean value blended with its all-moves-as-first
+    # value
+    def best_edge_rave(self, first, num, explore):
+        store = self.store
+        trials, cum_value, edge_node = store.trials, store.cum_value, store.edge_node
+        amaf_trials, amaf_value = store.amaf_trials, store.amaf_value
+        k = self.rave
+        top_ideal, top_edge = -math.inf, -1
+        for edge in range(first, first + num):
+            child = edge_node[edge]
+            visits = trials[child] if child >= 0 else 0
+            if amaf_trials[edge]:
+                beta = math.sqrt(k / (3 * visits + k))
+                value = beta * amaf_value[edge] / amaf_trials[edge]
+                if visits:
+                    value += (1 - beta) * cum_value[child] / visits
+                ideal = value + explore / math.sqrt(max(visits, 1))
+            elif visits:
+                ideal = cum_value[child] / visits + explore / math.sqrt(visits)
+            else:
+                ideal = self.unvisited_score
+            if ideal > top_ideal:
+                top_ideal, top_edge = ideal, edge
+        return top_edge
 
     # update node values for an iteration
     def do_round(self):
-        nodes, state = self.construct_path()
-        state.random_playout()
-        values = [state.players_beaten(i) for i in range(len(state.players))]
-        for nd in nodes:
-            nd.trials += 1
-            nd.cum_value += values[nd.player]
-
-    # find the path to a leaf using idealness while expanding nodes
-    def construct_path(self):
+        # with RAVE or MAST, the actions taken in the round as (node chosen at,
+        # or -1 in the playout, mover, action feature)
+        moves = [] if self.rave is not None or self.mast is not None else None
+        nodes, state = self.construct_path(moves)
+        values = self.playout(state, moves)
+        self.backpropagate(nodes, values, moves)
+        if self.stats is not None:
+            self.stats.rounds += 1
+            self.stats.depths[len(nodes) - 1] += 1
+
+    def playout(self, state, moves=None):
+        if moves is None:
+            length = state.random_playout(self.cutoff)
+        else:
+            length = self.recorded_playout(state, moves)
+        if self.stats is not None:
+            self.stats.playout_lengths[length] += 1
+        return evaluate(state)
+
+    # random_playout that adds the actions it takes to moves, choosing them by
+    # their features' values with MAST
+    def recorded_playout(self, state, moves):
+        state.hash = None
+        length = 0
+        while not state.is_over() and length != self.cutoff:
+            if self.mast is None:
+                action = state.random_action()
+                feature = state.action_feature(action)
+            else:
+                action, feature = self.mast_action(state)
+            moves.append((-1, state.whose_turn, feature))
+            state.apply_action(action)
+            length += 1
+        return length
+
+    # sample an action and its feature as random_action would, reweighted by
+    # the feature's MAST value
+    def mast_action(self, state):
+        actions = state.available_actions()
+        features = [state.action_feature(action) for action in actions]
+        # each move further along the road is half as likely before reweighting
+        base = 0.5 if state.turn == TokaidoGame.Action.MOVE else 1.0
+        weights = []
+        for i, feature in enumerate(features):
+            found = self.mast_values.get(feature)
+            value = found[1] / found[0] if found else MAST_DEFAULT_VALUE
+            weights.append(base**i * math.exp(value / self.mast))
+        i = state.rng.choices(range(len(actions)), weights)[0]
+        return actions[i], features[i]
+
+    def backpropagate(self, nodes, values, moves=None):
+        trials, cum_value, player = (
+            self.store.trials,
+            self.store.cum_value,
+            self.store.player,
+        )
+        for node in nodes:
+            trials[node] += 1
+            cum_value[node] += values[player[node]]
+        if moves is not None:
+            self.backpropagate_moves(moves, values)
+
+    # update MAST values and all-moves-as-first statistics from a round's
+    # actions
+    def backpropagate_moves(self, moves, values):
+        if self.mast is not None:
+            for _, mover, feature in moves:
+                found = self.mast_values.get(feature)
+                if found is None:
+                    found = self.mast_values[feature] = [0, 0.0]
+                found[0] += 1
+                found[1] += values[mover]
+        if self.rave is None:
+            return
+        store = self.store
+        edge_feature, amaf_trials, amaf_value = (
+            store.edge_feature,
+            store.amaf_trials,
+            store.amaf_value,
+        )
+        # features of the actions each player took from a point on, gathered
+        # from the end of the round back
+        later = [set() for _ in values]
+        for node, mover, feature in reversed(moves):
+            seen = later[mover]
+            seen.add(feature)
+            if node >= 0:
+                value = values[mover]
+                for edge in store.edges(node):
+                    if edge_feature[edge] in seen:
+                        amaf_trials[edge] += 1
+                        amaf_value[edge] += value
+
+    # the state a round starts from, drawing from the search's random numbers
+    def copy_state(self):
+        return self.current_state.clone(self.rng)
+
+    def expand(self, node, state):
+        actions = state.available_actions()
+        if self.widening is not None:
+            actions.sort(key=state.action_prior, reverse=True)
+        features = None
+        if self.rave is not None or self.mast is not None:
+            features = [state.action_feature(action) for action in actions]
+        self.store.expand(node, actions, features)
+        if self.stats is not None:
+            self.stats.branching[self.store.num_edges[node]] += 1
+
+    # find the path to a leaf using idealness while expanding nodes, adding the
+    # actions taken to moves if it is given
+    def construct_path(self, moves=None):
+        store = self.store
         nodes = [self.root]
-        state = deepcopy(self.current_state)
-        current_node = self.root
-        while current_node.trials > 0 and not state.is_over():
-            current_node.create_children(state)
-            action = current_node.best_action(state)
-            state.take_action(action)
-            current_node = current_node.children[action]
-            nodes.append(current_node)
+        state = self.copy_state()
+        node = self.root
+        while store.trials[node] > 0 and not state.is_over():
+            if store.first_edge[node] < 0:
+                self.expand(node, state)
+            step = len(nodes)
+            edge = self.best_edge(node)
+            mover = state.whose_turn
+            if moves is not None:
+                moves.append((node, mover, store.edge_feature[edge]))
+            state.take_action(store.edge_action[edge])
+            child = store.edge_node[edge]
+            if state.draws:
+                # statistics for the action are kept apart from those for
+                # each set of cards it can draw
+                if child < 0:
+                    child = store.edge_node[edge] = store.new_node(mover)
+                    store.outcomes[child] = {}
+                nodes.append(child)
+                outcomes = store.outcomes[child]
+                outcome = state.outcome()
+                if outcome not in outcomes:
+                    outcomes[outcome] = self.position_node(state, mover)
+                child = outcomes[outcome]
+            elif child < 0:
+                child = store.edge_node[edge] = self.position_node(state, mover)
+            nodes.append(child)
+            node = child
+            if self.prior_weight and store.trials[node] == 0:
+                self.add_prior(nodes[step:], state)
+                break
         return nodes, state
 
+    # give nodes that have not been visited prior_weight visits valued by the
+    # evaluator
+    def add_prior(self, nodes, state):
+        store = self.store
+        values = evaluate(state)
+        for node in nodes:
+            if store.trials[node] == 0:
+                store.trials[node] = self.prior_weight
+                store.cum_value[node] = self.prior_weight * values[store.player[node]]
+
+    # return the node for a position reached by mover's action, shared with
+    # any other path that has reached the same position
+    def position_node(self, state, mover):
+        if self.table is None or state.hash is None:
+            return self.store.new_node(mover)
+        key = state.hash ^ zobrist("mover", mover)
+        return self.table.lookup(key, lambda: self.store.new_node(mover))
+
+    # run a number of iterations, spread over the worker processes
+    def do_rounds(self, trials):
+        if self.workers <= 1:
+            for _ in range(trials):
+                self.do_round()
+        elif self.shared_tree:
+            self.do_shared_rounds(trials)
+        else:
+            self.do_root_rounds(trials)
+
+    # run iterations until the time budget, iteration count or node count is
+    # reached, or until more iterations could not change the best move; an
+    # endgame root is solved instead if that fits in part of the budget
+    def search(self, time_budget=None, max_iterations=None, max_nodes=None):
+        if time_budget is None and max_iterations is None and max_nodes is None:
+            raise ValueError("search needs a time, iteration or node limit")
+        start = time.perf_counter()
+        deadline = None if time_budget is None else start + time_budget
+        if (
+            self.solver is not None
+            and self.solved is None
+            and road_left(self.current_state) <= self.endgame
+        ):
+            max_iterations = self.solve_root(
+                start, time_budget, max_iterations, max_nodes
+            )
+        if self.solved:
+            seconds = time.perf_counter() - start
+            return SearchReport(0, seconds, 0.0, len(self.store), "solved")
+        key = self.current_state.hash
+        if self.book is not None and key is not None:
+            # trials taken from the book count toward the iteration limit
+            added = self.warm_start(self.book.lookup(key))
+            if max_iterations is not None:
+                max_iterations = max(0, max_iterations - added)
+        if self.workers > 1 and not self.shared_tree:
+            # root parallel workers each spend their whole share of the budget
+            # on one tree, as merging many trees of a few rounds each would
+            # only ever explore the first of the root's actions
+            time_left = None if deadline is None else deadline - time.perf_counter()
+            iterations, stop = self.do_root_rounds(max_iterations, time_left, max_nodes)
+        else:
+            iterations, stop = self.search_rounds(
+                start, deadline, max_iterations, max_nodes
+            )
+        if self.book is not None and key is not None and self.ply < self.book.plies:
+            self.book.store(key, self.root_results())
+        seconds = time.perf_counter() - start
+        return SearchReport(
+            iterations,
+            seconds,
+            iterations / seconds if seconds else 0.0,
+            len(self.store),
+            stop,
+        )
+
+    # solve the root with a share of the search's budget, returning the
+    # iteration limit left for the search if the solve does not finish
+    def solve_root(self, start, time_budget, max_iterations, max_nodes):
+        deadline = None
+        if time_budget is not None:
+            deadline = start + time_budget * SOLVE_SHARE
+        iterations = max_iterations
+        if max_nodes is not None:
+            room = max(0, max_nodes - len(self.store))
+            iterations = room if iterations is None else min(iterations, room)
+        positions = None
+        if iterations is not None:
+            positions = int(iterations * SOLVE_SHARE * SOLVE_POSITIONS_PER_ITERATION)
+        self.solved = self.solver.solve(self.current_state, deadline, positions) or {}
+        if max_iterations is not None:
+            max_iterations -= int(max_iterations * SOLVE_SHARE)
+        return max_iterations
+
+    # run iterations in this tree until a limit is reached, returning how many
+    # were run and which limit stopped them
+    def search_rounds(self, start, deadline, max_iterations, max_nodes):
+        # shared tree workers are handed whole batches, so the limits are
+        # checked per batch
+        step = 1 if self.workers <= 1 else self.workers * LEAVES_PER_WORKER
+        iterations = 0
+        nodes_only = max_iterations is None and deadline is None
+        size, grown_at = len(self.store), 0
+        while True:
+            now = time.perf_counter()
+            remaining = None
+            if max_iterations is not None:
+                remaining = max_iterations - iterations
+                if remaining <= 0:
+                    return iterations, "iterations"
+            if deadline is not None:
+                if now >= deadline:
+                    return iterations, "time"
+                if iterations:
+                    rate = iterations / (now - start)
+                    left = rate * (deadline - now)
+                    remaining = left if remaining is None else min(remaining, left)
+            if max_nodes is not None and len(self.store) >= max_nodes:
+                return iterations, "nodes"
+            if nodes_only:
+                if len(self.store) > size:
+                    size, grown_at = len(self.store), iterations
+                elif iterations - grown_at >= STALL_ROUNDS:
+                    return iterations, "complete"
+            if self.decided(remaining):
+                return iterations, "decided"
+            num = step if remaining is None else max(1, min(step, int(remaining)))
+            self.do_rounds(num)
+            iterations += num
+
+    # give the root's children the trials and values in entries where they
+    # have fewer, returning how many trials the root gained
+    def warm_start(self, entries):
+        if not entries:
+            return 0
+        store = self.store
+        root = self.root
+        if store.first_edge[root] < 0:
+            self.expand(root, self.current_state)
+        added = 0
+        for action, trials, cum_value in entries:
+            edge = store.find_edge(root, action)
+            if edge < 0:
+                continue
+            child = self.root_child(edge)
+            if trials > store.trials[child]:
+                added += trials - store.trials[child]
+                store.trials[child] = trials
+                store.cum_value[child] = cum_value
+        store.trials[root] += added
+        return added
+
+    # the child along one of the root's edges, made as construct_path would
+    # make it if the edge has not been followed yet
+    def root_child(self, edge):
+        store = self.store
+        child = store.edge_node[edge]
+        if child < 0:
+            state = self.copy_state()
+            state.take_action(store.edge_action[edge])
+            if state.draws:
+                child = store.new_node(self.to_move)
+                store.outcomes[child] = {}
+            else:
+                child = self.position_node(state, self.to_move)
+            store.edge_node[edge] = child
+        return child
+
+    # (action, trials, cumulative value) of each of the root's children
+    def root_results(self):
+        store = self.store
+        return [
+            (
+                store.edge_action[edge],
+                store.trials[store.edge_node[edge]],
+                store.cum_value[store.edge_node[edge]],
+            )
+            for edge in store.edges(self.root)
+            if store.edge_node[edge] >= 0 and store.trials[store.edge_node[edge]]
+        ]
+
+    # whether the most explored action at the root can no longer be overtaken
+    # in the given number of iterations
+    def decided(self, remaining):
+        store = self.store
+        first, second = 0, 0
+        for edge in store.edges(self.root):
+            child = store.edge_node[edge]
+            trials = store.trials[child] if child >= 0 else 0
+            if trials > first:
+                first, second = trials, first
+            elif trials > second:
+                second = trials
+        if first and store.num_edges[self.root] == 1:
+            return True
+        return remaining is not None and first - second > remaining
+
+    # root parallelization: independent searches whose root children are
+    # merged. trials, time_budget and max_nodes are shared out between the
+    # workers as search would apply them, returning the iterations run and the
+    # limit that stopped most workers. each worker starts a tree of its own,
+    # so nothing below the root is kept from one search to the next or shared
+    # through the transposition table
+    def do_root_rounds(self, trials, time_budget=None, max_nodes=None):
+        store = self.store
+        if trials is None:
+            shares = [None] * self.workers
+        else:
+            shares = [
+                trials // self.workers + (i < trials % self.workers)
+                for i in range(self.workers)
+            ]
+        if max_nodes is not None:
+            max_nodes = max(1, max_nodes // self.workers)
+        settings = {
+            "exploration": self.exploration,
+            "unvisited_score": self.unvisited_score,
+            "widening": self.widening,
+            "cutoff": self.cutoff,
+            "prior_weight": self.prior_weight,
+            "rave": self.rave,
+            "mast": self.mast,
+        }
+        # each worker gets a stream split off this search's, seeded with enough
+        # bits that streams do not overlap in practice
+        jobs = [
+            (
+                self.current_state,
+                num,
+                time_budget,
+                max_nodes,
+                self.rng.getrandbits(128),
+                settings,
+            )
+            for num in shares
+            if num is None or num
+        ]
+        if store.first_edge[self.root] < 0:
+            self.expand(self.root, self.current_state)
+        iterations = 0
+        stops = Counter()
+        for children, num, stop in worker_pool(self.workers).map(search_root, jobs):
+            iterations += num
+            stops[stop] += 1
+            for action, (trials, cum_value) in children.items():
+                child = self.root_child(store.find_edge(self.root, action))
+                store.trials[child] += trials
+                store.cum_value[child] += cum_value
+                store.trials[self.root] += trials
+        return iterations, stops.most_common(1)[0][0] if stops else "iterations"
+
+    # tree parallelization: select a batch of leaves using virtual loss, then
+    # play them out in parallel
+    def do_shared_rounds(self, trials):
+        store = self.store
+        pool = worker_pool(self.workers)
+        while trials > 0:
+            batch = min(trials, self.workers * LEAVES_PER_WORKER)
+            paths, jobs = [], []
+            for _ in range(batch):
+                nodes, state = self.construct_path()
+                # counting the visit before its value is known makes the path
+                # look worse, steering the rest of the batch elsewhere
+                for node in nodes:
+                    store.trials[node] += 1
+                paths.append(nodes)
+                # the worker seeds its own generator, so the search's is not
+                # pickled with the state
+                state.rng = None
+                jobs.append((state, self.rng.getrandbits(128), self.cutoff))
+            results = pool.map(playout_values, jobs, LEAVES_PER_WORKER)
+            for nodes, values in zip(paths, results):
+                for node in nodes:
+                    store.cum_value[node] += values[store.player[node]]
+            trials -= batch
+
+
+_pools = {}
+
+
+# process pools are shared by every search with the same number of workers
+def worker_pool(workers):
+    if workers not in _pools:
+        _pools[workers] = multiprocessing.Pool(workers)
+    return _pools[workers]
+
+
+@atexit.register
+def close_pools():
+    for pool in _pools.values():
+        pool.terminate()
+    _pools.clear()
+
+
+def search_root(job):
+    state, trials, time_budget, max_nodes, seed, settings = job
+    TokaidoGame.load_board()
+    tree = Mcts(state, seed=seed, **settings)
+    if time_budget is None and max_nodes is None:
+        for _ in range(trials):
+            tree.do_round()
+        iterations, stop = trials, "iterations"
+    else:
+        report = tree.search(time_budget, trials, max_nodes)
+        iterations, stop = report.iterations, report.stop
+    store = tree.store
+    children = {
+        store.edge_action[edge]: (
+            store.trials[store.edge_node[edge]],
+            store.cum_value[store.edge_node[edge]],
+        )
+        for edge in store.edges(tree.root)
+        if store.edge_node[edge] >= 0
+    }
+    return children, iterations, stop
+
+
+def playout_values(job):
+    state, seed, cutoff = job
+    TokaidoGame.load_board()
+    state.rng = random.Random(seed)
+    state.random_playout(cutoff)
+    return evaluate(state)
@@ -0,0 +1,96 @@
+import fcntl
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+
+# the file is a header followed by a fixed number of fixed size slots, each
+# holding a position hash, the write it was last stored by and the root
+# statistics of a search from that position as (action, trials, cumulative
+# value) entries. a hash is stored in one of the PROBES slots after hash
+# modulo the number of slots, replacing the one written longest ago when they
+# are all taken. a hash of 0 marks an empty slot
+MAGIC = b"TKBK"
+VERSION = 1
+HEADER = struct.Struct("<4sII4xQ")
+RECORD = struct.Struct("<QQH6x")
+ENTRY = struct.Struct("<IId")
+MAX_ACTIONS = 32
+SLOT_SIZE = RECORD.size + MAX_ACTIONS * ENTRY.size
+PROBES = 8
+
+
+class OpeningBook:
+    # root search results shared by every run and process using the same file.
+    # reads go through a memory map; writes are made under an exclusive lock
+    # on the file, and only for positions fewer than plies moves into a game
+    def __init__(self, path, slots=1 << 12, plies=24):
+        self.plies = plies
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self.locked(fcntl.LOCK_EX):
+            if os.fstat(self.fd).st_size == 0:
+                os.pwrite(self.fd, HEADER.pack(MAGIC, VERSION, slots, 0), 0)
+                os.ftruncate(self.fd, HEADER.size + slots * SLOT_SIZE)
+            magic, version, self.slots, _ = HEADER.unpack(
+                os.pread(self.fd, HEADER.size, 0)
+            )
+        if magic != MAGIC or version != VERSION:
+            os.close(self.fd)
+            raise ValueError("{} is not an opening book".format(path))
+        self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    @contextmanager
+    def locked(self, operation):
+        fcntl.flock(self.fd, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def offsets(self, key):
+        for i in range(PROBES):
+            yield HEADER.size + (key + i) % self.slots * SLOT_SIZE
+
+    # the entries stored for a position hash, or None
+    def lookup(self, key):
+        with self.locked(fcntl.LOCK_SH):
+            for offset in self.offsets(key):
+                found, _, num = RECORD.unpack_from(self.map, offset)
+                if found == key:
+                    return [
+                        ENTRY.unpack_from(
+                            self.map, offset + RECORD.size + i * ENTRY.size
+                        )
+                        for i in range(num)
+                    ]
+                if found == 0:
+                    return None
+        return None
+
+    # replace the entries for a position hash, keeping the most tried actions
+    # if there are more than fit
+    def store(self, key, entries):
+        entries = sorted(entries, key=lambda entry: entry[1], reverse=True)
+        entries = entries[:MAX_ACTIONS]
+        with self.locked(fcntl.LOCK_EX):
+            magic, version, slots, writes = HEADER.unpack_from(self.map, 0)
+            writes += 1
+            os.pwrite(self.fd, HEADER.pack(magic, version, slots, writes), 0)
+            target, oldest = None, None
+            for offset in self.offsets(key):
+                found, written, _ = RECORD.unpack_from(self.map, offset)
+                if found == key or found == 0:
+                    target = offset
+                    break
+                if oldest is None or written < oldest:
+                    target, oldest = offset, written
+            os.pwrite(
+                self.fd,
+                RECORD.pack(key, writes, len(entries))
+                + b"".join(ENTRY.pack(*entry) for entry in entries),
+                target,
+            )
@@ -0,0 +1,230 @@
+from tokaido_game import (
+    CARD_CODES,
+    CARD_FACES,
+    PANORAMAS,
+    SOUVENIR_TYPES,
+    Traveler,
+)
+from simulate_games import play_game
+import argparse
+import glob
+import multiprocessing
+import os
+import random
+import struct
+import numpy as np
+
+NUM_PLAYERS = 4
+# offers are padded to the most cards that can be on offer at once
+OFFERED = {"souvenirs": 3, "meals": NUM_PLAYERS + 1, "encounters": 2}
+PLAYER_SIZE = 9 + len(PANORAMAS) + len(SOUVENIR_TYPES)
+STATE_SIZE = (
+    6
+    + sum(OFFERED.values())
+    + sum(len(faces) for faces in CARD_FACES.values())
+    + NUM_PLAYERS * PLAYER_SIZE
+)
+# legal actions past this many are dropped, least visited first
+MAX_ACTIONS = 32
+
+# one row per decision of a self-play game: the position as encode_state gives
+# it, every legal action from it with its visits, 0 for actions the search
+# never tried (action -1 pads unused entries), the action taken and each
+# player's players_beaten at the end
+RECORD = np.dtype(
+    [
+        ("game", "<u4"),
+        ("ply", "<u2"),
+        ("mover", "u1"),
+        ("num_actions", "u1"),
+        ("state", "<i2", (STATE_SIZE,)),
+        ("actions", "<i2", (MAX_ACTIONS,)),
+        ("visits", "<u4", (MAX_ACTIONS,)),
+        ("chosen", "<i2"),
+        ("players_beaten", "<f4", (NUM_PLAYERS,)),
+    ]
+)
+
+# .npy files are written with a header of fixed size, so the row count in it
+# can be rewritten in place as rows are appended
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+
+def header_text(count):
+    return repr(
+        {
+            "descr": np.lib.format.dtype_to_descr(RECORD),
+            "fortran_order": False,
+            "shape": (count,),
+        }
+    )
+
+
+# room for any row count, rounded up to the 64 bytes .npy headers are padded to
+HEADER_SIZE = -(-(len(NPY_MAGIC) + 3 + len(header_text(1 << 63))) // 64) * 64
+
+
+def npy_header(count):
+    text = header_text(count).ljust(HEADER_SIZE - len(NPY_MAGIC) - 3) + "\n"
+    return NPY_MAGIC + struct.pack("<H", len(text)) + text.encode("latin1")
+
+
+# fixed length list of small integers describing a position: the turn, the
+# player to move, which panorama achievements are left and Satsuki's free meal,
+# the cards on offer, the cards left in each pile, then per player their
+# traveler, position, points, coins, eaten meals as a bitmask, encounters,
+# baths, donations, achievements, panoramas and souvenirs. cards are one more
+# than their code, with 0 for none
+def encode_state(game):
+    state = [game.turn, game.whose_turn]
+    state.extend(int(left) for left in game.pano_achievments)
+    meal = game.satsuki_meal_draw
+    state.append(0 if meal is None else CARD_CODES["meals"][meal] + 1)
+    # offers are only part of the position while they are being chosen from
+    offers = {
+        game.Action.BUY: ("souvenirs", game.available_souvenirs),
+        game.Action.EAT: ("meals", game.available_meals),
+        game.Action.CHOOSE_ENCOUNTER: ("encounters", game.encounter_choices),
+    }
+    for typ, size in OFFERED.items():
+        cards = []
+        if game.turn in offers and offers[game.turn][0] == typ:
+            cards = [CARD_CODES[typ][card] + 1 for card in offers[game.turn][1]]
+        state.extend(cards + [0] * (size - len(cards)))
+    for typ, faces in CARD_FACES.items():
+        state.extend(game.cards[typ].count(code) for code in range(len(faces)))
+    for player, position in zip(game.players, game.positions):
+        state.extend(
+            [
+                player.traveler,
+                position,
+                player.points,
+                player.coins,
+                player.meals,
+                player.encounters,
+                player.baths,
+                player.donations,
+                player.achievements,
+            ]
+        )
+        state.extend(player.panoramas)
+        state.extend(player.souvenirs)
+    return state
+
+
+class DatasetWriter:
+    # appends rows to a .npy file in chunks, so memory use is bounded by the
+    # chunk size however many rows are written; the header is brought up to
+    # date after each chunk, so the file can be memory mapped while it grows
+    def __init__(self, path, chunk=4096):
+        self.path = path
+        self.buffer = np.zeros(chunk, RECORD)
+        self.pending = 0
+        self.count = 0
+        self.file = open(path, "wb")
+        self.file.write(npy_header(0))
+
+    def append(self, game_id, ply, state, results, chosen, players_beaten):
+        if self.pending == len(self.buffer):
+            self.flush()
+        row = self.buffer[self.pending]
+        visits = {action: trials for action, trials, _ in results}
+        actions = sorted(
+            state.available_actions(),
+            key=lambda action: visits.get(action, 0),
+            reverse=True,
+        )[:MAX_ACTIONS]
+        row["game"] = game_id
+        row["ply"] = ply
+        row["mover"] = state.whose_turn
+        row["num_actions"] = len(actions)
+        row["state"] = encode_state(state)
+        row["actions"] = -1
+        row["visits"] = 0
+        for i, action in enumerate(actions):
+            row["actions"][i] = action
+            row["visits"][i] = visits.get(action, 0)
+        row["chosen"] = chosen
+        row["players_beaten"] = players_beaten
+        self.pending += 1
+
+    def flush(self):
+        self.file.write(self.buffer[: self.pending].tobytes())
+        self.count += self.pending
+        self.pending = 0
+        self.file.flush()
+        self.file.seek(0)
+        self.file.write(npy_header(self.count))
+        self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+# play the games in a job and append their decisions to one shard
+def write_shard(job):
+    path, games, trials, time_budget = job
+    names = [tvlr.name for tvlr in Traveler]
+    writer = DatasetWriter(path)
+    try:
+        for game_id, seed in games:
+            travelers = random.Random(seed).sample(names, NUM_PLAYERS)
+            decisions = []
+            game = play_game(
+                travelers,
+                trials,
+                time_budget=time_budget,
+                seed=seed,
+                decisions=decisions,
+            )
+            beaten = [game.players_beaten(i) for i in range(NUM_PLAYERS)]
+            for ply, (state, results, chosen) in enumerate(decisions):
+                writer.append(game_id, ply, state, results, chosen, beaten)
+    finally:
+        writer.close()
+    return path, writer.count
+
+
+# self-play games spread over one shard file per worker, named prefix-NNN.npy
+def generate(prefix, games, trials, time_budget=None, workers=1, seed=0):
+    jobs = [
+        (
+            "{}-{:03d}.npy".format(prefix, shard),
+            [
+                (game_id, "{} {}".format(seed, game_id))
+                for game_id in range(shard, games, workers)
+            ],
+            trials,
+            time_budget,
+        )
+        for shard in range(workers)
+    ]
+    with multiprocessing.Pool(workers) as pool:
+        for path, count in pool.imap_unordered(write_shard, jobs):
+            print("{0}: {1} decisions".format(path, count), flush=True)
+
+
+# the shards written by generate, memory mapped
+def load(prefix):
+    return [
+        np.load(path, mmap_mode="r")
+        for path in sorted(glob.glob(glob.escape(prefix) + "-[0-9][0-9][0-9].npy"))
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--trials", type=int, default=1000)
+    parser.add_argument(
+        "--seconds", type=float, help="stop each move's search after SECONDS"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="self_play", help="shard file prefix")
+    args = parser.parse_args()
+
+    generate(
+        args.output, args.games, args.trials, args.seconds, args.workers, args.seed
+    )
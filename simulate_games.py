@@ -1,16 +1,55 @@
 from math import nan
 from tokaido_game import TokaidoGame, Traveler
 from mcts import Mcts
+from opening_book import OpeningBook
+import argparse
 import itertools as itr
+import json
+import multiprocessing
+import os
+import random
 import cProfile
 
-def run_game(travelers, trials):
-    game = TokaidoGame(travelers)
+
+def play_game(
+    travelers,
+    trials,
+    workers=1,
+    shared_tree=False,
+    time_budget=None,
+    seed=None,
+    reports=None,
+    book=None,
+    decisions=None,
+):
+    # the game and the search get separate streams split from one seed
+    rng = random.Random(seed)
+    game = TokaidoGame(travelers, rng.getrandbits(128))
+    tree = Mcts(
+        game,
+        workers,
+        shared_tree,
+        seed=rng.getrandbits(128),
+        instrument=reports is not None,
+        book=book,
+    )
     while not game.is_over():
-        tree = Mcts(game)
-        for _ in range(trials):
-            tree.do_round()
-        game.take_action(tree.best_move())
+        tree.search(time_budget, trials)
+        if reports is not None:
+            reports.append(tree.report())
+        action = tree.best_move()
+        if decisions is not None:
+            # the position, the search's root statistics and the action chosen
+            decisions.append((game.clone(), tree.root_results(), action))
+        game.take_action(action)
+        tree.advance(action)
+    return game
+
+
+def run_game(
+    travelers, trials, workers=1, shared_tree=False, time_budget=None, seed=None
+):
+    game = play_game(travelers, trials, workers, shared_tree, time_budget, seed)
 
     for plyr in game.players:
         print(
@@ -21,23 +60,116 @@ def run_game(travelers, trials):
     return [game.players_beaten(i) for i in range(len(travelers))]
 
 
+# plays one seating of a tournament and returns its result record
+def play_seating(job):
+    seating, trials, time_budget, book_path = job
+    book = None if book_path is None else OpeningBook(book_path)
+    # seeded by the seating so a resumed tournament replays the same games
+    game = play_game(
+        seating, trials, time_budget=time_budget, seed=" ".join(seating), book=book
+    )
+    if book is not None:
+        book.close()
+    return {
+        "seating": list(seating),
+        "points": [plyr.points for plyr in game.players],
+        "achievements": [plyr.achievements for plyr in game.players],
+        "players_beaten": [game.players_beaten(i) for i in range(len(seating))],
+    }
+
+
+class Tournament:
+    # results are appended to a file as games finish, one JSON object per line,
+    # so an interrupted tournament picks up where it left off. with a
+    # book_path, searches share an OpeningBook kept in that file
+    def __init__(self, path, trials, time_budget=None, book_path=None):
+        self.path = path
+        self.trials = trials
+        self.time_budget = time_budget
+        self.book_path = book_path
+        self.names = [tvlr.name for tvlr in Traveler]
+        self.scores_by_tvlr = {s: 0 for s in self.names}
+        self.games_by_tvlr = {s: 0 for s in self.names}
+        self.scores_by_order = {i: 0 for i in range(4)}
+        self.games = 0
+        self.played = set()
+
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                data = f.read()
+                # drop a last record that was cut off mid-write
+                f.truncate(data.rfind(b"\n") + 1)
+            with open(path) as f:
+                for line in f:
+                    self.add(json.loads(line))
+
+    def add(self, record):
+        seating = record["seating"]
+        scores = record["players_beaten"]
+        for i in range(len(seating)):
+            self.scores_by_order[i] += scores[i]
+            self.scores_by_tvlr[seating[i]] += scores[i]
+            self.games_by_tvlr[seating[i]] += 1
+        self.games += 1
+        self.played.add(tuple(seating))
+
+    def run(self, seatings, workers):
+        jobs = [
+            (s, self.trials, self.time_budget, self.book_path)
+            for s in seatings
+            if tuple(s) not in self.played
+        ]
+        if not jobs:
+            return
+        with multiprocessing.Pool(workers) as pool, open(self.path, "a") as f:
+            for record in pool.imap_unordered(play_seating, jobs):
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                self.add(record)
+                print(
+                    "{0}: {1} ({2} games)".format(
+                        ", ".join(record["seating"]),
+                        record["players_beaten"],
+                        self.games,
+                    ),
+                    flush=True,
+                )
+
+    def report(self):
+        print(
+            [
+                s / self.games if self.games else nan
+                for s in self.scores_by_order.values()
+            ]
+        )
+        for n in self.names:
+            print(
+                n,
+                (
+                    self.scores_by_tvlr[n] / self.games_by_tvlr[n]
+                    if self.games_by_tvlr[n] != 0
+                    else nan
+                ),
+            )
+
+
 if __name__ == "__main__":
-    names = [tvlr.name for tvlr in Traveler]
-    scores_by_tvlr = {s: 0 for s in names}
-    games_by_tvlr = {s: 0 for s in names}
-    scores_by_order = {i: 0 for i in range(4)}
-    games = 0
-    for perm in itr.permutations(names, 4):
-        # cProfile.run('run_game(perm, 1000)')
-        scores = run_game(perm, 1000)
-        for i in range(4):
-            scores_by_order[i] += scores[i]
-            scores_by_tvlr[perm[i]] += scores[i]
-            games_by_tvlr[perm[i]] += 1
-        games += 1
-        break
-
-    print([s / games for s in scores_by_order.values()])
-    for n in names:
-        print(n, scores_by_tvlr[n] / games_by_tvlr[n] if games_by_tvlr[n] != 0 else nan)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=1000)
+    parser.add_argument(
+        "--seconds", type=float, help="stop each move's search after SECONDS"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--games", type=int, help="only play the first GAMES seatings")
+    parser.add_argument("--results", default="tournament_results.jsonl")
+    parser.add_argument(
+        "--book", help="warm-start searches from and add to an opening book at BOOK"
+    )
+    args = parser.parse_args()
 
+    names = [tvlr.name for tvlr in Traveler]
+    seatings = list(itr.islice(itr.permutations(names, 4), args.games))
+    # cProfile.run('run_game(seatings[0], 1000)')
+    tournament = Tournament(args.results, args.trials, args.seconds, args.book)
+    tournament.run(seatings, args.workers)
+    tournament.report()
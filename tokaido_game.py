@@ -1,7 +1,8 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import itertools as itr
 from enum import IntEnum, auto
 import random
+from bisect import bisect
 from typing import List
 
 DONATION_PTS = 1
@@ -57,6 +58,9 @@ SECTIONS = {"field": 3, "mountain": 4, "lake": 5}
 
 ACHIEVEMENT_PTS = 3
 
+# action code for passing on an encounter, panorama or meal
+PASS = 0
+
 STARTING_COINS = {
     "Chuubei": 4,
     "Hiroshige": 3,
@@ -84,25 +88,226 @@ class Traveler(IntEnum):
     Zen_emon = auto()
 
 
+Item = namedtuple("Item", ["type", "cost"])
+
+# cards are stored in piles as indices into these tables
+PANORAMAS = ["field", "mountain", "lake"]
+PANORAMA_INDEX = {pano: i for i, pano in enumerate(PANORAMAS)}
+PANORAMA_SIZES = [SECTIONS[pano] for pano in PANORAMAS]
+SOUVENIR_TYPES = ["fan", "food", "shirt", "statue"]
+SOUVENIR_INDEX = {typ: i for i, typ in enumerate(SOUVENIR_TYPES)}
+MEAL_INDEX = {typ: i for i, (typ, _, _) in enumerate(MEALS)}
+
+CARD_FACES = {
+    "encounters": [typ for typ, _ in ENCOUNTERS],
+    "meals": [Item(typ, cost) for typ, cost, _ in MEALS],
+    "souvenirs": [Item(typ, cost) for typ, cost, _ in SOUVENIRS],
+    "baths": [pts for pts, _ in BATHS],
+}
+CARD_CODES = {
+    typ: {face: code for code, face in enumerate(faces)}
+    for typ, faces in CARD_FACES.items()
+}
+STARTING_PILES = {
+    "encounters": bytearray(
+        i for i, (_, num) in enumerate(ENCOUNTERS) for _ in range(num)
+    ),
+    "meals": bytearray(i for i, (_, _, num) in enumerate(MEALS) for _ in range(num)),
+    "souvenirs": bytearray(
+        i for i, (_, _, num) in enumerate(SOUVENIRS) for _ in range(num)
+    ),
+    "baths": bytearray(i for i, (_, num) in enumerate(BATHS) for _ in range(num)),
+}
+
+
+class Deck:
+    # a pile of card codes kept at the front of a fixed array; a draw swaps a
+    # random card to the end of the pile and a returned card is written just
+    # past it, so neither moves the other cards or allocates
+    __slots__ = ("codes", "size")
+
+    def __init__(self, codes):
+        self.codes = bytearray(codes)
+        self.size = len(codes)
+
+    def clone(self):
+        other = Deck.__new__(Deck)
+        other.codes = self.codes[:]
+        other.size = self.size
+        return other
+
+    def __len__(self):
+        return self.size
+
+    # draw and put_back add a way to reverse them to log when it is given, as
+    # an (undo method, argument) pair
+    def draw(self, rng, log=None):
+        i = rng.randrange(self.size)
+        self.size -= 1
+        code = self.codes[i]
+        self.codes[i] = self.codes[self.size]
+        self.codes[self.size] = code
+        if log is not None:
+            log.append((self.undraw, i))
+        return code
+
+    def put_back(self, code, log=None):
+        if log is not None:
+            log.append((self.take_back, self.codes[self.size]))
+        self.codes[self.size] = code
+        self.size += 1
+
+    def undraw(self, i):
+        code = self.codes[self.size]
+        self.codes[self.size] = self.codes[i]
+        self.codes[i] = code
+        self.size += 1
+
+    def take_back(self, code):
+        self.size -= 1
+        self.codes[self.size] = code
+
+    def count(self, code):
+        return self.codes.count(code, 0, self.size)
+
+
+# what an action can change, saved by make_action so undo_action can put it
+# back: the mover's scalar fields and counts, every player's score only when
+# the action can end the game, the offers with the contents of the one the
+# action can remove cards from, and the log of cards drawn and put back
+UndoRecord = namedtuple(
+    "UndoRecord",
+    [
+        "mover",
+        "fields",
+        "panoramas",
+        "souvenirs",
+        "scores",
+        "position",
+        "occupied",
+        "turn",
+        "pano_achievments",
+        "offers",
+        "shrinking",
+        "satsuki_meal_draw",
+        "draws",
+        "hash",
+        "deck_log",
+        "rng_state",
+    ],
+)
+
+
+class CallCounter:
+    # counts calls to the main TokaidoGame methods under the phase of work the
+    # caller has set
+    def __init__(self):
+        self.phase = None
+        self.counts = {}
+
+    def count(self, name):
+        key = (self.phase, name)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+
+# set to a CallCounter to have TokaidoGame count its calls; None to not count
+call_counter = None
+
+
+ZOBRIST_KEYS = {}
+
+
+def zobrist(*key):
+    # random 64-bit key for a piece of a position, the same in every process
+    if key not in ZOBRIST_KEYS:
+        ZOBRIST_KEYS[key] = random.Random(repr(key)).getrandbits(64)
+    return ZOBRIST_KEYS[key]
+
+
 class TokaidoGame:
 
-    Item = namedtuple("Item", ["type", "cost"])
+    __slots__ = (
+        "cards",
+        "players",
+        "positions",
+        "occupied",
+        "turn",
+        "whose_turn",
+        "waiting_to_eat",
+        "gastro",
+        "pano_achievments",
+        "available_meals",
+        "available_souvenirs",
+        "encounter_choices",
+        "satsuki_meal_draw",
+        "draws",
+        "hash",
+        "rng",
+        "undo_log",
+    )
+
+    Item = Item
 
     board = []
+    # bitmasks over the board built by load_board: the spaces of each type and
+    # of each panorama, the spaces on the road and beside it, and the first
+    # space of each inn
+    space_masks = {}
+    pano_masks = []
+    road_mask = 0
+    side_mask = 0
+    inn_entry_mask = 0
 
     class Player:
+        __slots__ = (
+            "traveler",
+            "points",
+            "coins",
+            "meals",
+            "panoramas",
+            "encounters",
+            "baths",
+            "donations",
+            "souvenirs",
+            "achievements",
+        )
+
         def __init__(self, traveler):
             self.traveler = Traveler[traveler]
             self.points = 0
             self.coins = STARTING_COINS[traveler]
-            self.meals = []
-            self.panoramas = {"field": 0, "mountain": 0, "lake": 0}
+            # bitmask of eaten meals, indexed like MEALS
+            self.meals = 0
+            # counts indexed like PANORAMAS and SOUVENIR_TYPES
+            self.panoramas = [0] * len(PANORAMAS)
             self.encounters = 0
             self.baths = 0
             self.donations = 0
-            self.souvenirs = {"fan": 0, "food": 0, "shirt": 0, "statue": 0}
+            self.souvenirs = [0] * len(SOUVENIR_TYPES)
             self.achievements = 0
 
+        def clone(self):
+            other = TokaidoGame.Player.__new__(TokaidoGame.Player)
+            other.traveler = self.traveler
+            other.points = self.points
+            other.coins = self.coins
+            other.meals = self.meals
+            other.panoramas = self.panoramas[:]
+            other.encounters = self.encounters
+            other.baths = self.baths
+            other.donations = self.donations
+            other.souvenirs = self.souvenirs[:]
+            other.achievements = self.achievements
+            return other
+
+        def has_eaten(self, meal_type):
+            return self.meals >> MEAL_INDEX[meal_type] & 1
+
+        def coins_spent_on_meals(self):
+            return sum(
+                cost for i, (_, cost, _) in enumerate(MEALS) if self.meals >> i & 1
+            )
+
     class Space(IntEnum):
         INN = auto()
         SHOP = auto()
@@ -123,57 +328,159 @@ class TokaidoGame:
         CHOOSE_PANORAMA = auto()
         FINISHED = auto()
 
-    def __init__(self, travelers):
+    def __init__(self, travelers, seed=None):
 
         assert len(travelers) == 4
 
-        if not self.board:
-            with open("tokaido4p.txt") as f:
-                for s in f.read().split("\n"):
-                    self.board.append(getattr(self.Space, s))
-
-        self.cards = {
-            "encounters": [typ for typ, num in ENCOUNTERS for _ in range(num)],
-            "meals": [
-                self.Item(typ, cost) for typ, cost, num in MEALS for _ in range(num)
-            ],
-            "souvenirs": [
-                self.Item(typ, cost) for typ, cost, num in SOUVENIRS for _ in range(num)
-            ],
-            "baths": [pts for pts, num in BATHS for _ in range(num)],
-        }
+        self.load_board()
+
+        self.cards = {typ: Deck(pile) for typ, pile in STARTING_PILES.items()}
 
         self.players = [self.Player(tvlr) for tvlr in travelers]
         self.positions = list(range(len(travelers)))
+        # bitmask of the spaces in positions
+        self.occupied = (1 << len(travelers)) - 1
         self.turn = self.Action.MOVE
         self.whose_turn = 0
         self.waiting_to_eat = False
         self.gastro = 1
 
-        self.pano_achievments = {"field": True, "mountain": True, "lake": True}
+        self.pano_achievments = [True] * len(PANORAMAS)
+
+        self.available_meals = []
+        self.available_souvenirs = []
+        self.encounter_choices = []
+        self.satsuki_meal_draw = None
+        # cards drawn by the last action, one tuple per draw
+        self.draws = []
+        # Zobrist hash of the position, kept up to date by apply_action; None
+        # once a state stops tracking it
+        self.hash = self.compute_hash()
+        # source of every random choice the game makes
+        self.rng = random.Random(seed)
+        # where make_action collects the deck changes of the action it takes
+        self.undo_log = None
+
+    @classmethod
+    def load_board(cls):
+        if not cls.board:
+            with open("tokaido4p.txt") as f:
+                for s in f.read().split("\n"):
+                    cls.board.append(getattr(cls.Space, s))
+            cls.index_board()
+
+    @classmethod
+    def index_board(cls):
+        board = cls.board
+        cls.space_masks = {space: 0 for space in cls.Space}
+        cls.road_mask = cls.side_mask = cls.inn_entry_mask = 0
+        for pos, space in enumerate(board):
+            bit = 1 << pos
+            cls.space_masks[space] |= bit
+            if pos == len(board) - 1 or space != board[pos + 1]:
+                cls.road_mask |= bit
+            else:
+                cls.side_mask |= bit
+            if space == cls.Space.INN and board[pos - 1] != cls.Space.INN:
+                cls.inn_entry_mask |= bit
+        cls.pano_masks = [
+            cls.space_masks[cls.Space.FIELD + i] for i in range(len(PANORAMAS))
+        ]
+
+    def clone(self, rng=None):
+        # copies every mutable part of the state; much cheaper than deepcopy.
+        # the copy draws from rng when it is given, and otherwise from a copy
+        # of this state's generator, which costs several times the rest
+        other = TokaidoGame.__new__(TokaidoGame)
+        other.cards = {typ: deck.clone() for typ, deck in self.cards.items()}
+        other.players = [p.clone() for p in self.players]
+        other.positions = self.positions[:]
+        other.occupied = self.occupied
+        other.turn = self.turn
+        other.whose_turn = self.whose_turn
+        other.waiting_to_eat = self.waiting_to_eat
+        other.gastro = self.gastro
+        other.pano_achievments = self.pano_achievments[:]
+        other.available_meals = self.available_meals[:]
+        other.available_souvenirs = self.available_souvenirs[:]
+        other.encounter_choices = self.encounter_choices[:]
+        other.satsuki_meal_draw = self.satsuki_meal_draw
+        other.draws = self.draws[:]
+        other.hash = self.hash
+        if rng is None:
+            rng = random.Random()
+            rng.setstate(self.rng.getstate())
+        other.rng = rng
+        other.undo_log = None
+        return other
+
+    def __deepcopy__(self, memo):
+        return self.clone()
+
+    def player_hash(self, i):
+        player = self.players[i]
+        h = (
+            zobrist("traveler", i, player.traveler)
+            ^ zobrist("position", i, self.positions[i])
+            ^ zobrist("points", i, player.points)
+            ^ zobrist("coins", i, player.coins)
+            ^ zobrist("meals", i, player.meals)
+            ^ zobrist("encounters", i, player.encounters)
+            ^ zobrist("baths", i, player.baths)
+            ^ zobrist("donations", i, player.donations)
+            ^ zobrist("achievements", i, player.achievements)
+        )
+        for j, num in enumerate(player.panoramas):
+            h ^= zobrist("panorama", i, j, num)
+        for j, num in enumerate(player.souvenirs):
+            h ^= zobrist("souvenir", i, j, num)
+        return h
+
+    def table_hash(self):
+        # everything but the players and the piles
+        h = (
+            zobrist("turn", self.turn, self.whose_turn)
+            ^ zobrist("pano_achievments", *self.pano_achievments)
+            ^ zobrist("satsuki_meal_draw", self.satsuki_meal_draw)
+        )
+        # offers are only part of the position while they are being chosen from
+        if self.turn == self.Action.EAT:
+            h ^= zobrist("available_meals", *self.available_meals)
+        elif self.turn == self.Action.BUY:
+            h ^= zobrist("available_souvenirs", *self.available_souvenirs)
+        elif self.turn == self.Action.CHOOSE_ENCOUNTER:
+            h ^= zobrist("encounter_choices", *self.encounter_choices)
+        return h
+
+    def compute_hash(self):
+        h = self.table_hash()
+        for i in range(len(self.players)):
+            h ^= self.player_hash(i)
+        for typ, pile in self.cards.items():
+            for code in range(len(CARD_FACES[typ])):
+                h ^= zobrist("pile", typ, code, pile.count(code))
+        return h
 
     def next_player_turn(self):
         if self.turn == self.Action.EAT:
             behind = self.positions[self.whose_turn] - 1
-            if behind in self.positions:
+            if self.occupied >> behind & 1:
                 self.whose_turn = self.positions.index(behind)
             elif self.positions[self.whose_turn] == len(self.board) - len(self.players):
                 self.end_of_game()
             else:
                 self.turn = self.Action.MOVE
         else:
-            back = min(self.positions)
-            if (
-                self.board[back] == self.Space.INN
-                and self.board[back - 1] != self.Space.INN
-            ):
+            occupied = self.occupied
+            back = (occupied & -occupied).bit_length() - 1
+            if self.inn_entry_mask >> back & 1:
                 self.available_meals = self.draw_cards(
                     "meals", len(self.players) + 1 - self.gastro
                 )
-                self.whose_turn = self.positions.index(max(self.positions))
+                self.whose_turn = self.positions.index(occupied.bit_length() - 1)
                 self.turn = self.Action.EAT
             else:
-                self.whose_turn = self.positions.index(min(self.positions))
+                self.whose_turn = self.positions.index(back)
                 self.turn = self.Action.MOVE
 
     def on_road(self, position):
@@ -193,10 +500,10 @@ class TokaidoGame:
 
     def end_of_game(self):
 
-        spent = [sum([m.cost for m in p.meals]) for p in self.players]
+        spent = [p.coins_spent_on_meals() for p in self.players]
         baths = [p.baths for p in self.players]
         encounters = [p.encounters for p in self.players]
-        souvenirs = [sum(p.souvenirs.values()) for p in self.players]
+        souvenirs = [sum(p.souvenirs) for p in self.players]
         for category in [spent, baths, encounters, souvenirs]:
             most = max(category)
             for i, val in enumerate(category):
@@ -229,85 +536,76 @@ class TokaidoGame:
         return self.turn == self.turn.FINISHED
 
     def move_choices(self) -> List[int]:
-        player = self.players[self.whose_turn]
         choices = []
-        for pos in range(self.positions[self.whose_turn] + 1, len(self.board)):
-            if (
-                pos in self.positions
-                or (not self.on_road(pos) and pos + 1 not in self.positions)
-                or (
-                    (
-                        self.board[pos] == self.Space.SHOP
-                        or self.board[pos] == self.Space.TEMPLE
-                    )
-                    and player.coins < 1
-                )
-                or (
-                    self.board[pos] == self.Space.FIELD
-                    and player.panoramas["field"] >= SECTIONS["field"]
-                )
-                or (
-                    self.board[pos] == self.Space.MOUNTAIN
-                    and player.panoramas["mountain"] >= SECTIONS["mountain"]
-                )
-                or (
-                    self.board[pos] == self.Space.LAKE
-                    and player.panoramas["lake"] >= SECTIONS["lake"]
-                )
-            ):
-                continue
-
-            choices.append(pos)
-
-            if self.board[pos] == self.Space.INN:
-                return choices
+        legal = self.move_mask()
+        while legal:
+            low = legal & -legal
+            choices.append(low.bit_length() - 1)
+            legal ^= low
+        return choices
 
-    def purchase_choices(self) -> List[List[Item]]:
+    def move_mask(self) -> int:
+        # bitmask of the spaces the player to move can move to: unoccupied road
+        # spaces, and side spaces with the road space after them occupied, up to
+        # the first inn that can be reached
         player = self.players[self.whose_turn]
-        powerset = itr.chain.from_iterable(
-            itr.combinations(self.available_souvenirs, r)
-            for r in range(len(self.available_souvenirs) + 1)
-        )
-        return (
-            [
-                comb
-                for comb in powerset
-                if sum([souvenir.cost for souvenir in comb])
-                - max([souvenir.cost for souvenir in comb], default=1)
-                + 1
-                <= player.coins
-            ]
-            if player.traveler == Traveler.Zen_emon
-            else [
-                comb
-                for comb in powerset
-                if sum([souvenir.cost for souvenir in comb]) <= player.coins
-            ]
+        occupied = self.occupied
+        legal = ~occupied & (self.road_mask | self.side_mask & occupied >> 1)
+        legal &= -2 << self.positions[self.whose_turn]
+        if player.coins < 1:
+            legal &= ~(
+                self.space_masks[self.Space.SHOP] | self.space_masks[self.Space.TEMPLE]
+            )
+        for num, size, mask in zip(player.panoramas, PANORAMA_SIZES, self.pano_masks):
+            if num >= size:
+                legal &= ~mask
+        inns = legal & self.space_masks[self.Space.INN]
+        if inns:
+            legal &= ((inns & -inns) << 1) - 1
+        return legal
+
+    def purchase_choices(self) -> List[int]:
+        player = self.players[self.whose_turn]
+        return list(
+            PURCHASE_OPTIONS.affordable(
+                tuple(souvenir.cost for souvenir in self.available_souvenirs),
+                player.coins,
+                player.traveler == Traveler.Zen_emon,
+            )
         )
 
-    def pano_choices(self) -> List[str]:
+    def pano_choices(self) -> List[int]:
         player = self.players[self.whose_turn]
         return [
-            pano for pano, num in player.panoramas.items() if num < SECTIONS[pano]
-        ] + [None]
+            i + 1
+            for i, (num, size) in enumerate(zip(player.panoramas, PANORAMA_SIZES))
+            if num < size
+        ] + [PASS]
 
-    def meal_choices(self) -> List[Item]:
+    def meal_choices(self) -> List[int]:
         player = self.players[self.whose_turn]
         reduction = 1 if player.traveler == Traveler.Kinko else 0
         choices = [
-            meal
-            for meal in self.available_meals
-            if player.coins >= meal.cost - reduction and meal not in player.meals
-        ] + [None]
-        if (
-            player.traveler == Traveler.Satsuki
-            and self.satsuki_meal_draw not in player.meals
-        ):
-            choices.append(self.Item(self.satsuki_meal_draw.type, 0))
+            i + 1
+            for i, meal in enumerate(self.available_meals)
+            if player.coins >= meal.cost - reduction and not player.has_eaten(meal.type)
+        ] + [PASS]
+        if self.free_meal_offered():
+            choices.append(len(self.available_meals) + 1)
         return choices
 
+    def free_meal_offered(self):
+        player = self.players[self.whose_turn]
+        return (
+            player.traveler == Traveler.Satsuki
+            and self.satsuki_meal_draw is not None
+            and not player.has_eaten(self.satsuki_meal_draw.type)
+        )
+
     def available_actions(self) -> List:
-        # returns list of legal actions for the current player
+        # returns list of legal action codes for the current player
+        if call_counter is not None:
+            call_counter.count("available_actions")
 
         if self.turn == self.Action.FINISHED:
             return []
@@ -323,12 +621,99 @@ class TokaidoGame:
                 )
             )
         elif self.turn == self.Action.CHOOSE_ENCOUNTER:
-            return self.encounter_choices + [None]
+            return list(range(1, len(self.encounter_choices) + 1)) + [PASS]
         elif self.turn == self.Action.CHOOSE_PANORAMA:
             return self.pano_choices()
         elif self.turn == self.Action.EAT:
             return self.meal_choices()
 
+    def action_prior(self, action) -> float:
+        # cheap guess at how good an action is for the player to move, higher
+        # being better, for ordering actions before any have been searched
+        if self.turn == self.Action.MOVE:
+            # a short move leaves more turns to come
+            return self.positions[self.whose_turn] - action
+        elif self.turn == self.Action.BUY:
+            return bin(action).count("1")
+        elif self.turn in (
+            self.Action.EAT,
+            self.Action.CHOOSE_ENCOUNTER,
+            self.Action.CHOOSE_PANORAMA,
+        ):
+            return action != PASS
+        return 0
+
+    # actions are passed around as integer codes, relative to the current
+    # state: a move is the space moved to, a purchase a bitmask of indices
+    # into available_souvenirs, a donation the coins donated, and otherwise
+    # PASS or one more than the index of the encounter in encounter_choices,
+    # the panorama in PANORAMAS or the meal in available_meals, with one past
+    # the last meal for Satsuki's free meal
+    def decode_action(self, code):
+        # the action a code stands for
+        if self.turn == self.Action.MOVE or self.turn == self.Action.DONATE:
+            return code
+        elif self.turn == self.Action.BUY:
+            offered = self.available_souvenirs
+            return tuple(offered[i] for i in SUBSET_INDICES[code])
+        elif code == PASS:
+            return None
+        elif self.turn == self.Action.CHOOSE_ENCOUNTER:
+            return self.encounter_choices[code - 1]
+        elif self.turn == self.Action.CHOOSE_PANORAMA:
+            return PANORAMAS[code - 1]
+        elif code > len(self.available_meals):
+            return self.Item(self.satsuki_meal_draw.type, 0)
+        return self.available_meals[code - 1]
+
+    def encode_action(self, action):
+        # the code for an action
+        if self.turn == self.Action.MOVE or self.turn == self.Action.DONATE:
+            return action
+        elif self.turn == self.Action.BUY:
+            code = 0
+            for souvenir in action:
+                i = min(
+                    i
+                    for i, offered in enumerate(self.available_souvenirs)
+                    if offered == souvenir and not code >> i & 1
+                )
+                code |= 1 << i
+            return code
+        elif action is None:
+            return PASS
+        elif self.turn == self.Action.CHOOSE_ENCOUNTER:
+            return self.encounter_choices.index(action) + 1
+        elif self.turn == self.Action.CHOOSE_PANORAMA:
+            return PANORAMA_INDEX[action] + 1
+        elif action.cost == 0 and self.free_meal_offered():
+            return len(self.available_meals) + 1
+        return self.available_meals.index(action) + 1
+
+    def action_feature(self, code) -> int:
+        # what an action does, independent of the state, so statistics can be
+        # shared between similar actions in different positions: the turn
+        # times 128 plus the space moved to, a bitmask of the souvenir types
+        # bought, the coins donated, or one more than the index of the
+        # encounter, panorama or meal type chosen
+        turn = self.turn
+        if turn == self.Action.MOVE:
+            detail = code
+        elif turn == self.Action.BUY:
+            detail = 0
+            offered = self.available_souvenirs
+            for i in SUBSET_INDICES[code]:
+                detail |= 1 << SOUVENIR_INDEX[offered[i].type]
+        elif turn == self.Action.DONATE or code == PASS:
+            detail = code
+        elif turn == self.Action.CHOOSE_ENCOUNTER:
+            detail = CARD_CODES["encounters"][self.encounter_choices[code - 1]] + 1
+        elif turn == self.Action.CHOOSE_PANORAMA:
+            detail = code
+        else:
+            detail = MEAL_INDEX[self.decode_action(code).type] + 1
+        return turn * 128 + detail
+
     def collect_achievement(self, player: Player):
         player.achievements += 1
         player.points += ACHIEVEMENT_PTS
@@ -353,7 +738,7 @@ class TokaidoGame:
         elif typ == "donations":
             player.donations += ENCOUNTER_VALUE["donations"]
             player.points += ENCOUNTER_VALUE["donations"] * DONATION_PTS
-        elif player.panoramas[typ] < SECTIONS[typ]:
+        elif player.panoramas[PANORAMA_INDEX[typ]] < SECTIONS[typ]:
             self.collect_panorama(player, typ)
         else:
             return True
@@ -362,51 +747,253 @@ class TokaidoGame:
     def collect_souvenir(self, player: Player, typ):
         souvenirs = player.souvenirs
         assert (
-            typ in souvenirs
+            typ in SOUVENIR_INDEX
         ), "Attempted to collect {}, which is not a souvenir".format(typ)
-        pos = sum([n > souvenirs[typ] for n in souvenirs.values()])
-        souvenirs[typ] += 1
+        i = SOUVENIR_INDEX[typ]
+        pos = sum([n > souvenirs[i] for n in souvenirs])
+        souvenirs[i] += 1
         player.points += SOUVENIR_PTS[pos]
 
     def collect_panorama(self, player: Player, pano):
+        i = PANORAMA_INDEX[pano]
         assert (
-            player.panoramas[pano] < SECTIONS[pano]
+            player.panoramas[i] < PANORAMA_SIZES[i]
         ), "Attempted to collect a {}, but that panorama is already complete".format(
             pano
         )
-        player.panoramas[pano] += 1
-        player.points += player.panoramas[pano]
-        if player.panoramas[pano] == SECTIONS[pano] and self.pano_achievments[pano]:
-            self.pano_achievments[pano] = False
+        player.panoramas[i] += 1
+        player.points += player.panoramas[i]
+        if player.panoramas[i] == PANORAMA_SIZES[i] and self.pano_achievments[i]:
+            self.pano_achievments[i] = False
             self.collect_achievement(player)
 
     def draw_cards(self, typ, num) -> list:
+        if call_counter is not None:
+            call_counter.count("draw_cards")
         cards = []
         pile = self.cards[typ]
+        faces = CARD_FACES[typ]
+        rng = self.rng
+        log = self.undo_log
         while len(cards) < num and len(pile) > 0:
-            cards.append(pile.pop(random.randrange(len(pile))))
+            code = pile.draw(rng, log)
+            cards.append(faces[code])
+            if self.hash is not None:
+                left = pile.count(code)
+                self.hash ^= zobrist("pile", typ, code, left + 1) ^ zobrist(
+                    "pile", typ, code, left
+                )
+        # the order cards are drawn in does not matter, so offers are kept
+        # sorted and equal draws lead to identical states
+        cards.sort()
+        self.draws.append(tuple(cards))
         return cards
 
+    def outcome(self):
+        # the random part of the last transition
+        return tuple(self.draws)
+
+    def return_cards(self, typ, cards):
+        codes = CARD_CODES[typ]
+        pile = self.cards[typ]
+        for card in cards:
+            code = codes[card]
+            if self.hash is not None:
+                left = pile.count(code)
+                self.hash ^= zobrist("pile", typ, code, left) ^ zobrist(
+                    "pile", typ, code, left + 1
+                )
+            pile.put_back(code, self.undo_log)
+
+    def validate_action(self, action):
+        player = self.players[self.whose_turn]
+
+        if self.turn == self.Action.MOVE:
+            assert (
+                action >= 0 and self.move_mask() >> action & 1
+            ), "Attempted an illegal move"
+
+        elif self.turn == self.Action.BUY:
+            assert (
+                0 <= action < 1 << len(self.available_souvenirs)
+            ), "Attempted to buy a souvenir that is not for sale"
+            assert (
+                action in self.purchase_choices()
+            ), "Attempted to spend coins you do not have at a shop"
+
+        elif self.turn == self.Action.DONATE:
+            assert (
+                action >= MIN_DONATIONS
+            ), "Attempted to donate too few coins to a temple"
+            assert (
+                action <= MAX_DONATIONS
+            ), "Attempted to donate too many coins to a temple"
+            assert (
+                action <= player.coins
+            ), "Attempted to spend coins you do not have at a temple"
+
+        elif self.turn == self.Action.CHOOSE_ENCOUNTER:
+            assert (
+                0 <= action <= len(self.encounter_choices)
+            ), "Attempted to choose encounter {}, which is not available".format(action)
+
+        elif self.turn == self.Action.CHOOSE_PANORAMA:
+            assert (
+                action in self.pano_choices()
+            ), "Attempted to choose panorama {}, which is illegal".format(action)
+
+        elif self.turn == self.Action.EAT and action != PASS:
+            assert 0 < action <= len(self.available_meals) or (
+                action == len(self.available_meals) + 1 and self.free_meal_offered()
+            ), "Attempted to buy meal {}, which is not available".format(action)
+            meal = self.decode_action(action)
+            reduction = 1 if player.traveler == Traveler.Kinko else 0
+            assert not player.has_eaten(
+                meal.type
+            ), "Attempted to buy a {}, which you have already eaten".format(meal.type)
+            assert (
+                meal.cost - reduction <= player.coins
+            ), "Attempted to spend coins you do not have at an inn"
+
     def take_action(self, action) -> str:
         # transitions to next state
+        if call_counter is not None:
+            call_counter.count("take_action")
         assert (
             self.turn != self.Action.FINISHED
         ), "Attempted to take a turn when the game is finished"
 
+        self.validate_action(action)
+        message, args = self.apply_action(action)
+        return message.format(*args)
+
+    def make_action(self, action, restore_rng=False) -> UndoRecord:
+        # takes an action like take_action, returning a record of the state
+        # before it for undo_action; the random number source is only rewound
+        # with restore_rng, so by default undoing and retaking an action that
+        # draws cards can draw different ones
+        mover = self.whose_turn
+        player = self.players[mover]
+        turn = self.turn
+        # only a meal can end the game and score the other players
+        scores = None
+        shrinking = None
+        if turn == self.Action.EAT:
+            scores = [(p.points, p.achievements) for p in self.players]
+            shrinking = self.available_meals
+        elif turn == self.Action.BUY:
+            shrinking = self.available_souvenirs
+        elif turn == self.Action.CHOOSE_ENCOUNTER:
+            shrinking = self.encounter_choices
+        record = UndoRecord(
+            mover,
+            (
+                player.points,
+                player.coins,
+                player.meals,
+                player.encounters,
+                player.baths,
+                player.donations,
+                player.achievements,
+            ),
+            tuple(player.panoramas),
+            tuple(player.souvenirs),
+            scores,
+            self.positions[mover],
+            self.occupied,
+            turn,
+            tuple(self.pano_achievments),
+            (self.available_meals, self.available_souvenirs, self.encounter_choices),
+            None if shrinking is None else (shrinking, shrinking[:]),
+            self.satsuki_meal_draw,
+            self.draws,
+            self.hash,
+            [],
+            self.rng.getstate() if restore_rng else None,
+        )
+        self.undo_log = record.deck_log
+        self.take_action(action)
+        self.undo_log = None
+        return record
+
+    def undo_action(self, record: UndoRecord):
+        # returns to the state before the action make_action returned record for
+        mover = record.mover
+        player = self.players[mover]
+        (
+            player.points,
+            player.coins,
+            player.meals,
+            player.encounters,
+            player.baths,
+            player.donations,
+            player.achievements,
+        ) = record.fields
+        player.panoramas[:] = record.panoramas
+        player.souvenirs[:] = record.souvenirs
+        if record.scores is not None:
+            for other, (points, achievements) in zip(self.players, record.scores):
+                other.points = points
+                other.achievements = achievements
+        self.positions[mover] = record.position
+        self.occupied = record.occupied
+        self.turn = record.turn
+        self.whose_turn = mover
+        self.pano_achievments[:] = record.pano_achievments
+        (
+            self.available_meals,
+            self.available_souvenirs,
+            self.encounter_choices,
+        ) = record.offers
+        if record.shrinking is not None:
+            offer, cards = record.shrinking
+            offer[:] = cards
+        self.satsuki_meal_draw = record.satsuki_meal_draw
+        self.draws = record.draws
+        self.hash = record.hash
+        for undo, arg in reversed(record.deck_log):
+            undo(arg)
+        if record.rng_state is not None:
+            self.rng.setstate(record.rng_state)
+
+    def apply_action(self, action):
+        # transitions to next state without checking that the action is legal;
+        # returns a message template and its arguments rather than formatting it
+        if call_counter is not None:
+            call_counter.count("apply_action")
+        action = self.decode_action(action)
+        if self.hash is None:
+            return self.transition(action)
+
+        # only the player taking the action changes, until the game ends
+        mover = self.whose_turn
+        self.hash ^= self.player_hash(mover) ^ self.table_hash()
+        result = self.transition(action)
+        if self.turn == self.Action.FINISHED:
+            self.hash = self.compute_hash()
+        else:
+            self.hash ^= self.player_hash(mover) ^ self.table_hash()
+        return result
+
+    def transition(self, action):
+        # a new list rather than clearing the old one, which an UndoRecord
+        # may hold
+        self.draws = []
         player = self.players[self.whose_turn]
 
         if self.turn == self.Action.MOVE:
-            assert action in self.move_choices(), "Attempted an illegal move"
-
+            self.occupied ^= 1 << self.positions[self.whose_turn] | 1 << action
             self.positions[self.whose_turn] = action
             space = self.board[action]
 
             if space == self.Space.INN:
                 if player.traveler == Traveler.Satsuki:
                     self.satsuki_meal_draw = self.draw_cards("meals", 1)[0]
+                    self.next_player_turn()
 
-                    return "Satsuki arrives at the next inn is offered {} for free".format(
-                        self.satsuki_meal_draw.type
+                    return (
+                        "Satsuki arrives at the next inn is offered {0.type} for free",
+                        (self.satsuki_meal_draw,),
                     )
 
                 if action < len(self.board) - 5 and player.traveler == Traveler.Chuubei:
@@ -416,8 +1003,9 @@ class TokaidoGame:
                     else:
                         self.next_player_turn()
 
-                    return "Chuubei arrives at the next inn and receives {} from an encounter".format(
-                        encounter
+                    return (
+                        "Chuubei arrives at the next inn and receives {} from an encounter",
+                        (encounter,),
                     )
 
                 if (
@@ -428,7 +1016,7 @@ class TokaidoGame:
                 else:
                     self.next_player_turn()
 
-                return "{} arrives at the next inn".format(player.traveler.name)
+                return "{0.traveler.name} arrives at the next inn", (player,)
 
             elif space == self.Space.SHOP:
                 self.available_souvenirs = self.draw_cards(
@@ -436,22 +1024,24 @@ class TokaidoGame:
                 )
                 self.turn = self.Action.BUY
 
-                return "{0} goes to a shop and is offered {1}".format(
-                    player.traveler.name, self.available_souvenirs
+                return (
+                    "{0.traveler.name} goes to a shop and is offered {1}",
+                    (player, self.available_souvenirs),
                 )
 
             elif space == self.Space.TEMPLE:
                 self.turn = self.Action.DONATE
 
-                return "{} visits a temple".format(player.traveler.name)
+                return "{0.traveler.name} visits a temple", (player,)
 
             elif space == self.Space.ENCOUNTER:
                 if player.traveler == Traveler.Yoshiyasu:
                     self.encounter_choices = self.draw_cards("encounters", 2)
                     self.turn = self.Action.CHOOSE_ENCOUNTER
 
-                    return "Yoshiyasu has a choice between {0} and {1} encounters".format(
-                        self.encounter_choices[0], self.encounter_choices[1]
+                    return (
+                        "Yoshiyasu has a choice between {0[0]} and {0[1]} encounters",
+                        (self.encounter_choices,),
                     )
 
                 else:
@@ -461,15 +1051,16 @@ class TokaidoGame:
                     else:
                         self.next_player_turn()
 
-                    return "{0} receives {1} from an encounter".format(
-                        player.traveler.name, encounter
+                    return (
+                        "{0.traveler.name} receives {1} from an encounter",
+                        (player, encounter),
                     )
 
             elif space == self.Space.FARM:
                 player.coins += FARM_PAYMENT
                 self.next_player_turn()
 
-                return "{0} works at a farm".format(player.traveler.name)
+                return "{0.traveler.name} works at a farm", (player,)
 
             elif space == self.Space.HOT_SPRING:
                 bath = self.draw_cards("baths", 1)[0]
@@ -479,45 +1070,22 @@ class TokaidoGame:
                     player.pts += 1
                 self.next_player_turn()
 
-                return "{0} takes a bath for {1} points".format(
-                    player.traveler.name, bath
-                )
+                return "{0.traveler.name} takes a bath for {1} points", (player, bath)
 
             else:
-                self.collect_panorama(player, space.name.lower())
+                pano = PANORAMAS[space - self.Space.FIELD]
+                self.collect_panorama(player, pano)
                 self.next_player_turn()
 
-                return "{0} visits a {1}".format(
-                    player.traveler.name, space.name.lower()
-                )
+                return "{0.traveler.name} visits a {1}", (player, pano)
 
         elif self.turn == self.Action.BUY:
-            assert (
-                len(
-                    [
-                        souvenir
-                        for souvenir in action
-                        if souvenir not in self.available_souvenirs
-                    ]
-                )
-                == 0
-            ), "Attempted to buy a souvenir that is not for sale"
-
-            coins_needed = sum([souvenir.cost for souvenir in action])
-            if player.traveler == Traveler.Zen_emon:
-                coins_needed -= (
-                    max([souvenir.cost for souvenir in action], default=1) - 1
-                )
-            assert (
-                coins_needed <= player.coins
-            ), "Attempted to spend coins you do not have at a shop"
-
             for souvenir in action:
                 player.coins -= souvenir.cost
                 self.collect_souvenir(player, souvenir.type)
                 self.available_souvenirs.remove(souvenir)
 
-            self.cards["souvenirs"].extend(self.available_souvenirs)
+            self.return_cards("souvenirs", self.available_souvenirs)
 
             if player.traveler == Traveler.Zen_emon:
                 player.coins += (
@@ -528,18 +1096,9 @@ class TokaidoGame:
 
             self.next_player_turn()
 
-            return "{0} purchases {1}".format(player.traveler.name, action)
+            return "{0.traveler.name} purchases {1}", (player, action)
 
         elif self.turn == self.Action.DONATE:
-            assert (
-                action >= MIN_DONATIONS
-            ), "Attempted to donate too few coins to a temple"
-            assert (
-                action <= MAX_DONATIONS
-            ), "Attempted to donate too many coins to a temple"
-            assert (
-                action <= player.coins
-            ), "Attempted to spend coins you do not have at a temple"
             player.coins -= action
             if player.traveler == "Hirotoda":
                 action += 1
@@ -548,74 +1107,192 @@ class TokaidoGame:
 
             self.next_player_turn()
 
-            return "{0} donates {1} coins".format(player.traveler.name, action)
+            return "{0.traveler.name} donates {1} coins", (player, action)
 
         elif self.turn == self.Action.CHOOSE_ENCOUNTER:
             if action != None:
-                assert (
-                    action in self.encounter_choices
-                ), "Attempted to choose {}, which is not an available encounter".format(
-                    action
-                )
                 self.encounter_choices.remove(action)
-            self.cards["encounters"].extend(self.encounter_choices)
+            self.return_cards("encounters", self.encounter_choices)
             if action != None and self.collect_encounter(player, action):
                 self.turn = self.Action.CHOOSE_PANORAMA
             else:
                 self.next_player_turn()
 
-            return "{0} chooses a {1} encounter".format(player.traveler.name, action)
+            return "{0.traveler.name} chooses a {1} encounter", (player, action)
 
         elif self.turn == self.Action.CHOOSE_PANORAMA:
-            assert (
-                action in self.pano_choices()
-            ), "Attempted to choose a {}, which is an illegal panorama".format(action)
             if action != None:
                 self.collect_panorama(player, action)
             self.next_player_turn()
 
-            return "{0} chooses a {1} panorama".format(player.traveler.name, action)
+            return "{0.traveler.name} chooses a {1} panorama", (player, action)
 
         elif self.turn == self.Action.EAT:
             if action != None:
                 reduction = 1 if player.traveler == Traveler.Kinko else 0
                 free_meal = player.traveler == Traveler.Satsuki and action.cost == 0
                 meal = self.satsuki_meal_draw if free_meal else action
-                assert (
-                    action in self.available_meals or free_meal
-                ), "Attempted to buy a {}, which is not an available meal".format(
-                    action.type
-                )
-                assert (
-                    meal not in player.meals
-                ), "Attempted to buy a {}, which you have already eaten".format(
-                    action.type
-                )
-                assert (
-                    action.cost - reduction <= player.coins
-                ), "Attempted to spend coins you do not have at an inn"
                 player.points += MEAL_PTS
                 player.coins -= action.cost - reduction
-                player.meals.append(meal)
+                player.meals |= 1 << MEAL_INDEX[meal.type]
                 if not free_meal:
                     self.available_meals.remove(action)
 
             self.next_player_turn()
 
             return (
-                "{} skips a meal".format(player.traveler.name)
+                ("{0.traveler.name} skips a meal", (player,))
                 if action == None
-                else "{0} buys {1} for {2} coins".format(
-                    player.traveler.name, action.type, action.cost
+                else (
+                    "{0.traveler.name} buys {1.type} for {1.cost} coins",
+                    (player, action),
                 )
             )
 
-    def random_playout(self):
-        while self.turn != self.Action.FINISHED:
-            options = self.available_actions()
-            if self.turn == self.Action.MOVE:
-                weights = list(itr.accumulate([0.5] * len(options), lambda x, y: x * y))
-                action = random.choices(options, weights)[0]
-            else:
-                action = random.choice(options)
-            self.take_action(action)
+    def random_action(self):
+        # samples the action a random playout would take, drawing the same
+        # random numbers as self.rng.choice(available_actions()) without
+        # building the list of legal actions
+        player = self.players[self.whose_turn]
+        rng = self.rng
+
+        if self.turn == self.Action.MOVE:
+            choices = _move_buffer
+            n = self.fill_move_choices(choices)
+            total = MOVE_CUM_WEIGHTS[n - 1]
+            return choices[bisect(MOVE_CUM_WEIGHTS, rng.random() * total, 0, n - 1)]
+
+        elif self.turn == self.Action.BUY:
+            return PURCHASE_OPTIONS.sample(
+                tuple(souvenir.cost for souvenir in self.available_souvenirs),
+                player.coins,
+                player.traveler == Traveler.Zen_emon,
+                rng,
+            )
+
+        elif self.turn == self.Action.DONATE:
+            return MIN_DONATIONS + rng.randrange(
+                min(MAX_DONATIONS, player.coins) + 1 - MIN_DONATIONS
+            )
+
+        elif self.turn == self.Action.CHOOSE_ENCOUNTER:
+            i = rng.randrange(len(self.encounter_choices) + 1)
+            return i + 1 if i < len(self.encounter_choices) else PASS
+
+        elif self.turn == self.Action.CHOOSE_PANORAMA:
+            choices = _pano_buffer
+            n = 0
+            for i, (num, size) in enumerate(zip(player.panoramas, PANORAMA_SIZES)):
+                if num < size:
+                    choices[n] = i + 1
+                    n += 1
+            choices[n] = PASS
+            return choices[rng.randrange(n + 1)]
+
+        elif self.turn == self.Action.EAT:
+            reduction = 1 if player.traveler == Traveler.Kinko else 0
+            choices = _meal_buffer
+            n = 0
+            for i, meal in enumerate(self.available_meals):
+                if player.coins >= meal.cost - reduction and not player.has_eaten(
+                    meal.type
+                ):
+                    choices[n] = i + 1
+                    n += 1
+            choices[n] = PASS
+            n += 1
+            if self.free_meal_offered():
+                choices[n] = len(self.available_meals) + 1
+                n += 1
+            return choices[rng.randrange(n)]
+
+    def fill_move_choices(self, choices) -> int:
+        # writes the legal moves into choices and returns how many there are
+        legal = self.move_mask()
+        n = 0
+        while legal:
+            low = legal & -legal
+            choices[n] = low.bit_length() - 1
+            n += 1
+            legal ^= low
+        return n
+
+    def random_playout(self, limit=None) -> int:
+        # plays random actions to the end, or until limit actions have been
+        # taken, and returns how many it took; the position is thrown away
+        # afterwards, so skip keeping its hash
+        self.hash = None
+        length = 0
+        while self.turn != self.Action.FINISHED and length != limit:
+            self.apply_action(self.random_action())
+            length += 1
+        return length
+
+
+# scratch space reused by random_action so playouts do not allocate lists
+_move_buffer = [0] * 128
+_pano_buffer = [PASS] * (len(PANORAMAS) + 1)
+_meal_buffer = [PASS] * (len(MEALS) + 2)
+
+# cumulative weights random_playout has always used for moves, where each move
+# further along the road is half as likely as the one before it
+MOVE_CUM_WEIGHTS = list(
+    itr.accumulate(itr.accumulate([0.5] * len(_move_buffer), lambda x, y: x * y))
+)
+
+# index subsets of the souvenirs on offer, in the order purchase_choices lists
+# their codes
+SUBSETS = [
+    list(
+        itr.chain.from_iterable(itr.combinations(range(num), r) for r in range(num + 1))
+    )
+    for num in range(SOUVENIRS_OFFERED + 1)
+]
+# the offer indices in each purchase code
+SUBSET_INDICES = [
+    tuple(i for i in range(SOUVENIRS_OFFERED) if code >> i & 1)
+    for code in range(1 << SOUVENIRS_OFFERED)
+]
+
+
+class PurchaseOptions:
+    # bounded memo of the affordable subsets of a souvenir offer, keyed by the
+    # offer's costs, the coins that matter and whether one souvenir costs 1;
+    # the least recently used offer is forgotten when it is full
+    def __init__(self, size=4096):
+        self.size = size
+        self.subsets = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # purchase codes for the subsets of the offer that can be paid for, in
+    # SUBSETS order
+    def affordable(self, costs, coins, discount):
+        # coins beyond the price of the whole offer make no difference
+        key = (costs, min(coins, sum(costs)), discount)
+        found = self.subsets.get(key)
+        if found is not None:
+            self.hits += 1
+            self.subsets.move_to_end(key)
+            return found
+
+        self.misses += 1
+        found = []
+        for subset in SUBSETS[len(costs)]:
+            price = sum(costs[i] for i in subset)
+            if discount:
+                price -= max([costs[i] for i in subset], default=1) - 1
+            if price <= coins:
+                found.append(sum(1 << i for i in subset))
+        found = self.subsets[key] = tuple(found)
+        if len(self.subsets) > self.size:
+            self.subsets.popitem(last=False)
+        return found
+
+    # the code of an affordable subset chosen uniformly at random
+    def sample(self, costs, coins, discount, rng):
+        subsets = self.affordable(costs, coins, discount)
+        return subsets[rng.randrange(len(subsets))]
+
+
+PURCHASE_OPTIONS = PurchaseOptions()